@@ -13,17 +13,32 @@ import uuid
 import getpass
 import threading
 import logging
+import random
+import json
+import hmac
+import collections
+import abc
+import re
+import gzip
+import tracemalloc
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timezone
 from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler
 
-# Windows Specific Imports
-import win32event
-import win32api
-import winerror
-import winreg as reg
-import win32print
+# Windows Specific Imports (optional so the simulated spooler and tooling run on other hosts)
+try:
+    import win32event
+    import win32api
+    import winerror
+    import winreg as reg
+    import win32print
+except ImportError:
+    win32event = win32api = winerror = reg = win32print = None
 
 # Third Party
 import requests
+from requests.adapters import HTTPAdapter
 import pystray
 from PIL import Image
 import shutil
@@ -43,6 +58,64 @@ DC_PAPERNAMES   = 16
 DC_BINNAMES     = 12
 DC_BINS         = 6
 DC_COLORDEVICE  = 32
+PRINTER_CHANGE_PRINTER        = 0x000000FF
+PRINTER_CHANGE_PRINTER_DRIVER = 0x70000000
+SPOOLER_DEBOUNCE = 0.5          # Seconds of quiet before a burst of spooler events is diffed
+# Job Scheduler (overridable from [Scheduler] in agent.ini)
+SCHEDULER = None
+SCHEDULER_WORKERS = 4           # Max printers driven in parallel
+DEADLINE_SLACK = 60             # Seconds before a deadline at which a job jumps to the front
+# Printer Pools (from [Pools] in agent.ini: pool_uid = Printer A, Printer B, ...)
+PRINTER_POOLS = {}
+POOL_FAILOVER_COOLDOWN = 60     # Seconds a failed pool member is skipped before being retried
+COALESCE_WINDOW = 0.25          # Seconds a new PDF job waits for companions with identical settings
+COALESCE_MAX_JOBS = 20          # Max PDF documents handed to one SumatraPDF invocation
+SUMATRA_PATH = None
+# Job Watchdog (overridable from [Scheduler] in agent.ini)
+PDF_TIMEOUT = 120               # Seconds per document before SumatraPDF is killed
+RAW_TIMEOUT = 30                # Seconds before a blocked RAW spooler write is abandoned
+WEDGED_PRINTERS = {}            # printer -> helper thread still stuck in a Win32 call
+# Hold Queue (overridable from [Scheduler] in agent.ini)
+PRINTER_READY_STATES = ('online', 'printing')
+PRINTER_MISSING = 'missing'     # Health status for a printer the spooler doesn't know; its jobs fail instead of being held
+ERROR_INVALID_PRINTER_NAME = 1801
+HOLD_CHECK_INTERVAL = 5         # Seconds between status checks of printers with held jobs
+HOLD_RELEASE_INTERVAL = 2       # Seconds between dispatches while a recovered printer drains its held jobs
+# Long-Poll pacing (overridable from [Poll] in agent.ini)
+POLL_HOLD = 25                  # Seconds the server holds a poll open (server may advertise X-Poll-Hold)
+POLL_HOLD_MAX = 120
+POLL_NETWORK_BUFFER = 10        # Added to the hold time for the request timeout
+POLL_BACKOFF_BASE = 1           # Full-jitter backoff: uniform(0, min(cap, base * 2^failures))
+POLL_BACKOFF_CAP = 60
+POLL_IDLE_MAX = 30              # Max delay between empty polls when the server isn't holding them
+POLL_REPORT_INTERVAL = 300      # Seconds between connection-state log lines
+# Gateway mode: one process serving several [Tenant:<name>] sections from agent.ini
+TENANTS = []
+GATEWAY_MODE = False
+HTTP = requests.Session()       # Shared connection pool for every tenant
+CAPABILITY_CACHE = {}           # printer -> (scanned at, printer entry), shared by every tenant
+CAPABILITY_CACHE_TTL = 300
+CAPABILITY_LOCK = threading.Lock()
+# Local Job API (from [LocalAPI] in agent.ini) for LAN callers that skip the cloud round trip
+LOCAL_API_ENABLED = False
+LOCAL_API_BIND = "127.0.0.1"
+LOCAL_API_PORT = 8790
+LOCAL_API_TOKEN = ""
+LOCAL_API_MAX_BYTES = 50 * 1024 * 1024
+# In-flight job memory (from [Memory] in agent.ini); 0 disables the ceiling
+MEMORY_LIMIT = 256 * 1024 * 1024    # Job bytes held in RAM before the agent stops taking jobs
+MEMORY_SPILL_BYTES = 8 * 1024 * 1024 # Payloads larger than this go straight to disk
+SPOOL_CHUNK = 4 * 64 * 1024          # base64 characters decoded per write (multiple of 4)
+RAW_CHUNK = 64 * 1024                # Bytes per WritePrinter call when streaming a spilled RAW job
+RAW_STRIP = b"\r\n\x00 "             # Trailing whitespace/delimiters that cause blank labels
+# Remote profiling (started by the server's 'profile' poll command)
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+PROFILE_INTERVAL = 0.01         # Seconds between stack samples
+PROFILE_TOP_N = 25
+PROFILE_LOCK = threading.Lock() # One capture at a time
+PROFILE_TRACEMALLOC = False     # Trace allocations from startup so captures can show the live heap (costs CPU and RAM)
+AGENT_COMPILED = os.path.splitext(__file__)[1].lower() in ('.pyd', '.so')  # Cython release build
 # Application Paths (Safe placeholders)
 application_path = ""
 config_file = ""
@@ -74,6 +147,51 @@ def get_os_display_name():
             return f"{os_name} {platform.release()}"
     return f"{os_name} {platform.release()}"
 
+class Tenant(object):
+    """One license key / server id. A normal agent has one; gateway mode serves many."""
+    def __init__(self, name, api, license_key, server_id=None, printers=None):
+        self.name = name
+        self.api = api
+        self.license_key = license_key
+        self.server_id = server_id or generate_server_id(license_key, uuid.getnode())
+        self.printers = printers        # Printer/pool uids this tenant may see and use (None = all)
+        self.tag = f"[{name}] " if GATEWAY_MODE else ""
+        self.poll = None
+        self.headers = {
+            "X-License-Key": license_key, 
+            "X-Server-ID": self.server_id, 
+            "X-Agent-Version": AGENT_VERSION,
+            "X-OS-User": getpass.getuser(),
+            "X-OS-Name": get_os_display_name()
+        }
+
+    def allows(self, printer_uid):
+        return self.printers is None or printer_uid in self.printers
+
+def join_tags(tags):
+    # "[a] ", "[b] " -> "[a][b] "
+    tags = sorted({tag.strip() for tag in tags if tag})
+    return "".join(tags) + " " if tags else ""
+
+def printer_tag(name):
+    # Log prefix for a printer or pool: the tag of every tenant that can use it, directly or through a pool
+    if not GATEWAY_MODE:
+        return ""
+    pools = [uid for uid, pool in PRINTER_POOLS.items() if name in pool.members]
+    return join_tags(t.tag for t in TENANTS if t.allows(name) or any(t.allows(uid) for uid in pools))
+
+def log_line_visible(line, tenant):
+    # Gateway mode: a tenant only sees lines tagged for it; untagged lines may name anyone's printers
+    message = line.split(" | ", 2)[-1]
+    tags = re.match(r"((?:\[[^\]]*\])+) ", message)
+    return bool(tags) and tenant.tag.strip() in tags.group(1)
+
+def configure_http(pool_size):
+    # Long-polls hold a connection each, so size the pool for every tenant plus the workers
+    adapter = HTTPAdapter(pool_connections=max(4, len(TENANTS)), pool_maxsize=pool_size)
+    HTTP.mount("http://", adapter)
+    HTTP.mount("https://", adapter)
+
 def set_run_at_startup(app_name, action="install"):
     if platform.system() != "Windows": return False
     registry_key = r"Software\Microsoft\Windows\CurrentVersion\Run"
@@ -140,81 +258,286 @@ def load_logo():
         except: pass
     return Image.new('RGB', (64, 64), (34, 113, 177))
 
-def print_pdf(content_base64, printer_name, orientation='portrait', color_mode=None, duplex_mode=None, paper_size=None, bin_name=None):
-    pdf_data = base64.b64decode(content_base64)
-    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
-        f.write(pdf_data)
-        temp_path = f.name
+def find_sumatra():
+    # Smart Discovery for SumatraPDF (cached: the lookup runs once per process, not per job)
+    global SUMATRA_PATH
+    if SUMATRA_PATH:
+        return SUMATRA_PATH
+    search_locations = []
+
+    # 1. Check if bundled inside PyInstaller EXE (_MEIPASS)
+    if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
+        search_locations.append(os.path.join(sys._MEIPASS, "SumatraPDF.exe"))
+
+    # 2. Check locally next to the EXE
+    search_locations.append(os.path.join(application_path, "SumatraPDF.exe"))
+
+    # 3. Check System PATH
+    sys_exe = shutil.which("SumatraPDF.exe")
+    if sys_exe: search_locations.append(sys_exe)
+
+    # 4. Common Program Files
+    search_locations.extend([
+        r"C:\Program Files\SumatraPDF\SumatraPDF.exe",
+        r"C:\Program Files (x86)\SumatraPDF\SumatraPDF.exe"
+    ])
+
+    for p in search_locations:
+        if p and os.path.exists(p):
+            SUMATRA_PATH = p
+            break
+    return SUMATRA_PATH
+
+def build_print_settings(orientation='portrait', color_mode=None, duplex_mode=None, paper_size=None, bin_name=None):
+    # Build settings string based on orientation and other preferences
+    settings_list = ["fit", "noscale", orientation or 'portrait']
+    if color_mode: settings_list.append(color_mode)
+    if duplex_mode:
+        sd_duplex = "duplexlong" if duplex_mode == "duplex" else "simplex"
+        settings_list.append(sd_duplex)
+    if paper_size: settings_list.append(f"paper={paper_size}")
+    if bin_name: settings_list.append(f"bin={bin_name}")
+    return ",".join(settings_list)
+
+class JobTimeout(Exception):
+    pass
+
+class JobCancelled(Exception):
+    pass
 
+def is_printer_failure(error):
+    # Timeouts and Win32 spooler errors (pywintypes.error carries .winerror) point at the
+    # printer. Anything else - a bad document, a non-zero SumatraPDF exit - follows the job.
+    return isinstance(error, JobTimeout) or getattr(error, 'winerror', None) is not None
+
+def wait_with_watchdog(wait, timeout, should_cancel=None):
+    # wait(seconds) blocks up to `seconds` and returns True once the engine is done.
+    # Returns None on completion, or 'timeout' / 'cancelled' if the watchdog fires first.
+    deadline = time.monotonic() + timeout if timeout else None
+    while True:
+        tick = 0.5 if deadline is None else max(0, min(0.5, deadline - time.monotonic()))
+        if wait(tick):
+            return None
+        if should_cancel and should_cancel():
+            return 'cancelled'
+        if deadline is not None and time.monotonic() >= deadline:
+            return 'timeout'
+
+def kill_process_tree(proc):
+    # SumatraPDF can leave helper processes behind; taskkill /T takes the whole tree down
     try:
-        logger.info(f"Starting print job for printer: {printer_name}")
         if platform.system() == "Windows":
-            # Smart Discovery for SumatraPDF
-            sumatra_path = None
-            search_locations = []
-            
-            # 1. Check if bundled inside PyInstaller EXE (_MEIPASS)
-            if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
-                search_locations.append(os.path.join(sys._MEIPASS, "SumatraPDF.exe"))
-                
-            # 2. Check locally next to the EXE
-            search_locations.append(os.path.join(application_path, "SumatraPDF.exe"))
-            
-            # 3. Check System PATH
-            sys_exe = shutil.which("SumatraPDF.exe")
-            if sys_exe: search_locations.append(sys_exe)
-            
-            # 4. Common Program Files
-            search_locations.extend([
-                r"C:\Program Files\SumatraPDF\SumatraPDF.exe",
-                r"C:\Program Files (x86)\SumatraPDF\SumatraPDF.exe"
-            ])
-
-            for p in search_locations:
-                if p and os.path.exists(p):
-                    sumatra_path = p
-                    break
+            subprocess.run(["taskkill", "/F", "/T", "/PID", str(proc.pid)], capture_output=True, timeout=10,
+                           creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+    except Exception as e:
+        logger.warning(f"taskkill failed for PID {proc.pid}: {e}")
+    try:
+        proc.kill()
+        proc.wait(timeout=5)
+    except Exception:
+        pass
 
-            if sumatra_path:
-                # Build settings string based on orientation and other preferences
-                settings_list = ["fit", "noscale", orientation]
-                if color_mode: settings_list.append(color_mode)
-                if duplex_mode: 
-                    sd_duplex = "duplexlong" if duplex_mode == "duplex" else "simplex"
-                    settings_list.append(sd_duplex)
-                if paper_size: settings_list.append(f"paper={paper_size}")
-                if bin_name: settings_list.append(f"bin={bin_name}")
-                
-                settings = ",".join(settings_list)
-                logger.info(f"Executing SumatraPDF ({sumatra_path}): -print-to \"{printer_name}\" -print-settings \"{settings}\"")
-                subprocess.run([sumatra_path, "-print-to", printer_name, "-print-settings", settings, temp_path], check=True)
-                logger.info("Job successfully sent to SumatraPDF")
-            else:
-                logger.warning("SumatraPDF not found in bundle, local dir or PATH. Falling back to ShellExecute (Simple Printing).")
+def run_engine(cmd, timeout, should_cancel=None):
+    if should_cancel and should_cancel():
+        raise JobCancelled("Cancelled by server")
+    proc = subprocess.Popen(cmd)
+    def _wait(seconds):
+        try:
+            proc.wait(timeout=seconds)
+            return True
+        except subprocess.TimeoutExpired:
+            return False
+    reason = wait_with_watchdog(_wait, timeout, should_cancel)
+    if reason:
+        logger.error(f"Watchdog: killing {os.path.basename(cmd[0])} (PID {proc.pid}) - {reason}")
+        kill_process_tree(proc)
+        if reason == 'cancelled':
+            raise JobCancelled("Cancelled by server")
+        raise JobTimeout(f"{os.path.basename(cmd[0])} did not finish within {timeout}s")
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+class MemoryBudget(object):
+    """Bytes of job payload held in RAM, per stage, against MEMORY_LIMIT.
+
+    Stages are 'poll' (a response body being parsed), 'payload' (base64
+    content waiting to be spooled) and 'print' (decoded RAW data). Spool
+    files on disk are not counted. Over the ceiling the poll loop stops asking
+    for jobs and new payloads are spilled to disk on arrival. In gateway mode
+    each tenant also gets an equal share of the ceiling, so one tenant's
+    backlog can't pause job intake for the others.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.stages = collections.Counter()
+        self.by_tenant = collections.Counter()  # tenant name -> bytes
+        self.lock = threading.Condition(threading.RLock())
+        self.was_over = set()                   # None (whole budget) and tenant names currently over
+
+    def charge(self, stage, size, tenant=None):
+        with self.lock:
+            self.stages[stage] += size
+            if tenant is not None:
+                self.by_tenant[tenant.name] += size
+        self._check(tenant)
+
+    def credit(self, stage, size, tenant=None):
+        with self.lock:
+            self.stages[stage] -= size
+            if tenant is not None:
+                self.by_tenant[tenant.name] -= size
+        self._check(tenant)
+
+    @property
+    def used(self):
+        with self.lock:
+            return sum(self.stages.values())
+
+    def share(self):
+        return self.limit // max(1, len(TENANTS))
+
+    def tenant_used(self, tenant):
+        with self.lock:
+            return self.by_tenant[tenant.name]
+
+    def over(self, tenant=None):
+        if self.limit <= 0:
+            return False
+        if self.used >= self.limit:
+            return True
+        return tenant is not None and self.tenant_used(tenant) >= self.share()
+
+    def headroom(self, tenant=None):
+        # None when unlimited
+        if self.limit <= 0:
+            return None
+        room = self.limit - self.used
+        if tenant is not None:
+            room = min(room, self.share() - self.tenant_used(tenant))
+        return max(0, room)
+
+    def snapshot(self, tenant=None):
+        # A tenant sees the totals and its own usage, never another tenant's
+        with self.lock:
+            snap = dict(self.stages, limit=self.limit)
+            if tenant is not None and len(TENANTS) > 1:
+                snap.update(tenant_used=self.by_tenant[tenant.name], share=self.share())
+            return snap
+
+    def wait_for_room(self, timeout, tenant=None):
+        # Blocks until usage drops under the ceiling (or timeout); True if there is room
+        with self.lock:
+            return self.lock.wait_for(lambda: not self.over(tenant), timeout)
+
+    def _check(self, tenant):
+        if self.limit <= 0:
+            return
+        with self.lock:
+            states = {None: (self.used >= self.limit, "")}
+            if tenant is not None and len(TENANTS) > 1:
+                states[tenant.name] = (self.tenant_used(tenant) >= self.share(), tenant.tag)
+            for key, (over, tag) in states.items():
+                if over == (key in self.was_over):
+                    continue
+                what = "budget" if key is None else "its share of the budget"
+                snap = self.snapshot(tenant if key is not None else None)
+                if over:
+                    self.was_over.add(key)
+                    logger.warning(f"{tag}In-flight job memory over {what}, pausing job intake: {snap}")
+                else:
+                    self.was_over.discard(key)
+                    logger.info(f"{tag}In-flight job memory back under {what}: {snap}")
+                    self.lock.notify_all()
+
+BUDGET = MemoryBudget(MEMORY_LIMIT)
+
+def write_spool_file(content_base64, suffix=".pdf"):
+    # Decoded in chunks so a large document never exists twice in memory
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+        if any(c in content_base64[:SPOOL_CHUNK] for c in "\r\n "):
+            f.write(base64.b64decode(content_base64))  # Line-wrapped base64: chunk edges won't align
+        else:
+            for start in range(0, len(content_base64), SPOOL_CHUNK):
+                f.write(base64.b64decode(content_base64[start:start + SPOOL_CHUNK]))
+        return f.name
+
+def print_pdf_files(paths, printer_name, settings, should_cancel=None):
+    # SumatraPDF prints every file on its command line, so a batch costs one engine start
+    tag = printer_tag(printer_name)
+    logger.info(f"{tag}Starting print job for printer: {printer_name} ({len(paths)} document(s))")
+    if platform.system() == "Windows":
+        sumatra_path = find_sumatra()
+        if sumatra_path:
+            logger.info(f"{tag}Executing SumatraPDF ({sumatra_path}): -print-to \"{printer_name}\" -print-settings \"{settings}\"")
+            run_engine([sumatra_path, "-print-to", printer_name, "-print-settings", settings] + list(paths),
+                       PDF_TIMEOUT * len(paths), should_cancel)
+            logger.info(f"{tag}Job successfully sent to SumatraPDF")
+        else:
+            logger.warning("SumatraPDF not found in bundle, local dir or PATH. Falling back to ShellExecute (Simple Printing).")
+            for temp_path in paths:
                 win32api.ShellExecute(0, "print", temp_path, f'/d:"{printer_name}"', ".", 0)
-                logger.info("Job sent via ShellExecute")
-    except Exception as e:
-        logger.error(f"ERROR in print_pdf: {e}")
-        raise e
-    finally:
-        try: os.unlink(temp_path)
-        except: pass
+            logger.info(f"{tag}Job sent via ShellExecute")
 
-def print_raw(content_base64, printer_name):
-    # Strip any trailing whitespace or command delimiters that cause blank pages
-    raw_data = base64.b64decode(content_base64).strip(b"\r\n\x00 ")
-    
-    hPrinter = win32print.OpenPrinter(printer_name)
+def is_printer_wedged(printer_name):
+    worker = WEDGED_PRINTERS.get(printer_name)
+    if worker is not None and not worker.is_alive():
+        WEDGED_PRINTERS.pop(printer_name, None)
+        return False
+    return worker is not None
+
+def delete_spooled_job(printer_name, spool_job_id):
     try:
-        # RAW mode implies we send control characters directly. 
-        # Redundant StartPagePrinter calls often trigger extra form-feeds on thermal printers.
-        win32print.StartDocPrinter(hPrinter, 1, ("Cloud Print Job", None, "RAW"))
+        hPrinter = win32print.OpenPrinter(printer_name)
         try:
-            win32print.WritePrinter(hPrinter, raw_data)
+            win32print.SetJob(hPrinter, spool_job_id, 0, None, win32print.JOB_CONTROL_DELETE)
         finally:
-            win32print.EndDocPrinter(hPrinter)
-    finally:
-        win32print.ClosePrinter(hPrinter)
+            win32print.ClosePrinter(hPrinter)
+        logger.info(f"{printer_tag(printer_name)}Deleted spooler job {spool_job_id} on {printer_name}")
+    except Exception as e:
+        logger.warning(f"{printer_tag(printer_name)}Failed to delete spooler job {spool_job_id} on {printer_name}: {e}")
+
+def print_raw_data(raw_data, printer_name, timeout=None, should_cancel=None):
+    # The Win32 calls can block forever on a wedged driver, so they run on a helper thread.
+    # If the watchdog fires, the spooled document is deleted and the thread is abandoned;
+    # the printer is skipped by the scheduler until that thread finally returns.
+    state = {"spool_job_id": None, "error": None}
+
+    def _write():
+        try:
+            hPrinter = win32print.OpenPrinter(printer_name)
+            try:
+                # RAW mode implies we send control characters directly. 
+                # Redundant StartPagePrinter calls often trigger extra form-feeds on thermal printers.
+                state["spool_job_id"] = win32print.StartDocPrinter(hPrinter, 1, ("Cloud Print Job", None, "RAW"))
+                try:
+                    # Spilled jobs arrive as a SpooledRaw and are streamed from disk
+                    for chunk in ([raw_data] if isinstance(raw_data, bytes) else raw_data):
+                        if should_cancel and should_cancel():
+                            break
+                        win32print.WritePrinter(hPrinter, chunk)
+                finally:
+                    win32print.EndDocPrinter(hPrinter)
+            finally:
+                win32print.ClosePrinter(hPrinter)
+        except Exception as e:
+            state["error"] = e
+
+    if should_cancel and should_cancel():
+        raise JobCancelled("Cancelled by server")
+    worker = threading.Thread(target=_write, name=f"RawWrite-{printer_name}", daemon=True)
+    worker.start()
+    reason = wait_with_watchdog(lambda seconds: (worker.join(seconds), not worker.is_alive())[1],
+                                RAW_TIMEOUT if timeout is None else timeout, should_cancel)
+    if reason:
+        logger.error(f"{printer_tag(printer_name)}Watchdog: RAW write to {printer_name} blocked - {reason}")
+        WEDGED_PRINTERS[printer_name] = worker
+        if state["spool_job_id"]:
+            delete_spooled_job(printer_name, state["spool_job_id"])
+        if reason == 'cancelled':
+            raise JobCancelled("Cancelled by server")
+        raise JobTimeout(f"RAW write to {printer_name} did not finish within {RAW_TIMEOUT if timeout is None else timeout}s")
+    if state["error"] is not None:
+        raise state["error"]
 
 def update_status(icon, message, tooltip=None):
     # This might be called from background thread
@@ -234,36 +557,54 @@ def update_status(icon, message, tooltip=None):
     # Actually pystray doesn't need thread-safe menu updates, but good practice
     _update()
 
+def decode_printer_status(raw_status):
+    # Map Windows spooler status bitmask to a human-readable status
+    if raw_status & 0x00000080:       # PRINTER_STATUS_OFFLINE
+        return 'offline'
+    elif raw_status & 0x00000002:      # PRINTER_STATUS_ERROR
+        return 'error'
+    elif raw_status & 0x00000008:      # PRINTER_STATUS_PAPER_JAM
+        return 'error'
+    elif raw_status & 0x00000010:      # PRINTER_STATUS_PAPER_OUT
+        return 'error'
+    elif raw_status & 0x00100000:      # PRINTER_STATUS_USER_INTERVENTION
+        return 'error'
+    elif raw_status & 0x00000001:      # PRINTER_STATUS_PAUSED
+        return 'paused'
+    elif raw_status & 0x00000400:      # PRINTER_STATUS_PRINTING
+        return 'printing'
+    return 'online'
+
+def get_printer_health(printer_name):
+    # Lightweight probe (status + spooler queue depth, no capability scan) for routing decisions
+    if DEV_MODE:
+        return 'online', 0
+    try:
+        hPrinter = win32print.OpenPrinter(printer_name)
+        try:
+            info = win32print.GetPrinter(hPrinter, 2)
+        finally:
+            win32print.ClosePrinter(hPrinter)
+        return decode_printer_status(info.get('Status', 0)), info.get('cJobs', 0)
+    except Exception as e:
+        if getattr(e, 'winerror', None) == ERROR_INVALID_PRINTER_NAME:
+            return PRINTER_MISSING, 0
+        logger.warning(f"{printer_tag(printer_name)}Failed to query status for {printer_name}: {e}")
+        return 'offline', 0
+
 def get_printer_properties(printer_name):
+    tag = printer_tag(printer_name)
     try:
-        logger.info(f"Scanning capabilities for printer: {printer_name}")
+        logger.info(f"{tag}Scanning capabilities for printer: {printer_name}")
         hPrinter = win32print.OpenPrinter(printer_name)
         try:
             # 1. Get Basic Info & Current Defaults
             info = win32print.GetPrinter(hPrinter, 2)
             dm = info['pDevMode']
 
-            # Map Windows spooler status bitmask to a human-readable status
             raw_status = info.get('Status', 0)
-            if raw_status & 0x00000080:       # PRINTER_STATUS_OFFLINE
-                hw_status = 'offline'
-            elif raw_status & 0x00000002:      # PRINTER_STATUS_ERROR
-                hw_status = 'error'
-            elif raw_status & 0x00000008:      # PRINTER_STATUS_PAPER_JAM
-                hw_status = 'error'
-            elif raw_status & 0x00000010:      # PRINTER_STATUS_PAPER_OUT
-                hw_status = 'error'
-            elif raw_status & 0x00100000:      # PRINTER_STATUS_USER_INTERVENTION
-                hw_status = 'error'
-            elif raw_status & 0x00000001:      # PRINTER_STATUS_PAUSED
-                hw_status = 'paused'
-            elif raw_status & 0x00000400:      # PRINTER_STATUS_PRINTING
-                hw_status = 'printing'
-            elif raw_status == 0:
-                hw_status = 'online'
-            else:
-                hw_status = 'online'
-            logger.info(f"  - Windows Status Bitmask: {raw_status} -> {hw_status}")
+            hw_status = decode_printer_status(raw_status)
+            logger.info(f"{tag}  - Windows Status Bitmask: {raw_status} -> {hw_status}")
 
             res = {
                 "orientation": "portrait",
@@ -287,7 +628,7 @@ def get_printer_properties(printer_name):
                     "duplex": "duplex" if dm.Duplex > 1 else "simplex",
                 })
             
-            logger.info(f"  - Defaults: {res['orientation']}, {res['color']}, {res['duplex']}")
+            logger.info(f"{tag}  - Defaults: {res['orientation']}, {res['color']}, {res['duplex']}")
 
             # 2. Scan Device Capabilities (The "Menu" of options)
             # DC_COLORDEVICE returns 1 if hardware supports color
@@ -298,7 +639,7 @@ def get_printer_properties(printer_name):
                 # Label printers (Zebra, DYMO) don't support this call — expected
                 res["has_color"] = False
                 if "too small" not in str(e).lower():
-                    logger.warning(f"  - Failed to scan color support: {e}")
+                    logger.warning(f"{tag}  - Failed to scan color support: {e}")
 
             # DC_PAPERNAMES returns a list of supported paper names
             try:
@@ -306,34 +647,35 @@ def get_printer_properties(printer_name):
                 if papers:
                     # Clean up strings (they are often null-padded)
                     res["supported_papers"] = [p.strip("\x00") for p in papers if p.strip("\x00")]
-                logger.info(f"  - Found {len(res['supported_papers'])} Paper Sizes: {', '.join(res['supported_papers'][:3])}...")
+                logger.info(f"{tag}  - Found {len(res['supported_papers'])} Paper Sizes: {', '.join(res['supported_papers'][:3])}...")
             except Exception as e:
-                logger.warning(f"  - Failed to scan paper sizes: {e}")
+                logger.warning(f"{tag}  - Failed to scan paper sizes: {e}")
 
             # DC_BINNAMES returns a list of supported input bins
             try:
                 bins = win32print.DeviceCapabilities(printer_name, "", DC_BINNAMES)
                 if bins:
                     res["supported_bins"] = [b.strip("\x00") for b in bins if b.strip("\x00")]
-                logger.info(f"  - Found {len(res['supported_bins'])} Input Trays: {', '.join(res['supported_bins'])}")
+                logger.info(f"{tag}  - Found {len(res['supported_bins'])} Input Trays: {', '.join(res['supported_bins'])}")
             except Exception as e:
-                logger.warning(f"  - Failed to scan input trays: {e}")
+                logger.warning(f"{tag}  - Failed to scan input trays: {e}")
 
             return res
 
         finally:
             win32print.ClosePrinter(hPrinter)
     except Exception as e:
-        logger.error(f"ERROR scanning properties for {printer_name}: {e}")
+        logger.error(f"{tag}ERROR scanning properties for {printer_name}: {e}")
     return {}
 
 import traceback
 
 def get_all_presets(printer_name):
     """Get ALL available presets/paper sizes/bins for a printer"""
+    tag = printer_tag(printer_name)
     presets = []
     try:
-        logger.info(f"  - Debug: Beginning preset scan for {printer_name}")
+        logger.info(f"{tag}  - Debug: Beginning preset scan for {printer_name}")
         hPrinter = win32print.OpenPrinter(printer_name)
         try:
             # Get paper names + sizes + bins
@@ -346,21 +688,21 @@ def get_all_presets(printer_name):
             bin_ids     = []
             
             try: paper_names = win32print.DeviceCapabilities(printer_name, "", DC_PAPERNAMES)
-            except: logger.warning(f"    - Driver failed to provide paper names")
+            except: logger.warning(f"{tag}    - Driver failed to provide paper names")
             
             try: paper_sizes = win32print.DeviceCapabilities(printer_name, "", DC_PAPERS)
-            except: logger.warning(f"    - Driver failed to provide paper codes (DC_PAPERS)")
+            except: logger.warning(f"{tag}    - Driver failed to provide paper codes (DC_PAPERS)")
             
             try: paper_dims = win32print.DeviceCapabilities(printer_name, "", DC_PAPERSIZE)
-            except: logger.warning(f"    - Driver failed to provide paper dimensions (DC_PAPERSIZE) — width/height will be 0")
+            except: logger.warning(f"{tag}    - Driver failed to provide paper dimensions (DC_PAPERSIZE) — width/height will be 0")
             
             try: bin_names = win32print.DeviceCapabilities(printer_name, "", DC_BINNAMES)
-            except: logger.warning(f"    - Driver failed to provide bin names")
+            except: logger.warning(f"{tag}    - Driver failed to provide bin names")
             
             try: bin_ids = win32print.DeviceCapabilities(printer_name, "", DC_BINS)
             except: pass
 
-            logger.info(f"  - paper_names={len(paper_names)}, paper_sizes={len(paper_sizes)}, paper_dims={len(paper_dims)}, bin_names={len(bin_names)}")
+            logger.info(f"{tag}  - paper_names={len(paper_names)}, paper_sizes={len(paper_sizes)}, paper_dims={len(paper_dims)}, bin_names={len(bin_names)}")
 
             # Build paper presets
             if paper_names:
@@ -424,202 +766,1537 @@ def get_all_presets(printer_name):
                         })
                     except: continue
 
-            logger.info(f"  - Collected {len(presets)} presets for {printer_name}")
+            logger.info(f"{tag}  - Collected {len(presets)} presets for {printer_name}")
         finally:
             win32print.ClosePrinter(hPrinter)
 
     except Exception as e:
-        logger.error(f"ERROR collecting presets for {printer_name}: {e}")
-        logger.error(traceback.format_exc())
+        logger.error(f"{tag}ERROR collecting presets for {printer_name}: {e}")
+        logger.error(f"{tag}{traceback.format_exc()}")
 
     return presets
 
-def upload_logs(line_count=100):
+def upload_logs(line_count=100, tenant=None):
+    tenant = tenant or TENANTS[0]
     try:
         if os.path.exists(log_path):
             with open(log_path, 'r', encoding='utf-8', errors='ignore') as f:
                 content = f.read()
                 lines = content.splitlines()
+
+                # Gateway mode: never hand one tenant the lines about another
+                if GATEWAY_MODE:
+                    lines = [l for l in lines if log_line_visible(l, tenant)]
                 
                 # Fetch specified number of lines, or 0 for full log
                 target_lines = lines if line_count == 0 else lines[-abs(line_count):]
                 
-                header = f"--- REMOTE LOG DUMP (Server: {SERVER_ID}, Version: {AGENT_VERSION}) ---\n"
-                header += f"--- Range: {'Full Log' if line_count == 0 else f'Last {len(target_lines)} lines'} ---\n\n"
+                header = f"--- REMOTE LOG DUMP (Server: {tenant.server_id}, Version: {AGENT_VERSION}) ---\n"
+                header += f"--- Range: {'Full Log' if line_count == 0 else f'Last {len(target_lines)} lines'} ---\n"
+                if tenant.poll:
+                    header += f"--- Connection: {tenant.poll.snapshot()} ---\n"
+                header += f"--- Job memory: {BUDGET.snapshot(tenant)} ---\n"
+                header += "\n"
                 
                 summary = header + "\n".join(target_lines)
-                requests.post(f"{API}/api/agent/upload_logs", json={"logs": summary}, headers=HEADERS, timeout=60)
+                HTTP.post(f"{tenant.api}/api/agent/upload_logs", json={"logs": summary}, headers=tenant.headers, timeout=60)
     except Exception as e:
         logger.error(f"Failed to upload logs: {e}")
 
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def capture_profile(seconds, interval=PROFILE_INTERVAL, top_n=PROFILE_TOP_N, tenant=None):
+    # Statistical profile of every thread: sample sys._current_frames() on a timer so
+    # the agent keeps running normally (cProfile would only see the calling thread).
+    # The release build compiles this module with Cython, whose functions have no
+    # Python frames: there only stdlib/library frames (where threads block) show up.
+    tenant = tenant or TENANTS[0]
+    me = threading.get_ident()
+    # Gateway mode: another tenant's poll thread is none of this tenant's business
+    hidden = {f"Poll-{t.name}" for t in TENANTS if t is not tenant}
+    names = {}
+    stacks = collections.Counter()      # "thread;outer;...;inner" -> samples (flame graph input)
+    own = collections.Counter()         # function -> samples where it was the running frame
+    total = collections.Counter()       # function -> samples where it was anywhere on the stack
+    # Tracing since startup ([Profile] tracemalloc) gives the live heap; otherwise only
+    # what is allocated during the capture can be seen.
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(10)
+    before = tracemalloc.take_snapshot()
+    samples = 0
+    started = time.monotonic()
+    while time.monotonic() - started < seconds:
+        names.update((t.ident, t.name) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            name = names.get(ident, str(ident))
+            if ident == me or name in hidden:
+                continue
+            chain = []
+            while frame is not None:
+                chain.append(frame_label(frame))
+                frame = frame.f_back
+            chain.reverse()
+            stacks[";".join([name] + chain)] += 1
+            own[chain[-1]] += 1
+            total.update(set(chain))
+        samples += 1
+        time.sleep(interval)
+    elapsed = time.monotonic() - started
+
+    after = tracemalloc.take_snapshot()
+    traced_bytes, traced_peak = tracemalloc.get_traced_memory()
+    if started_tracing:
+        tracemalloc.stop()
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    after = after.filter_traces(filters)
+    memory = {
+        "tracing_since": "capture" if started_tracing else "startup",
+        "growth": [str(s) for s in after.compare_to(before.filter_traces(filters), 'lineno')[:top_n]],
+        "traced_bytes": traced_bytes,
+        "traced_peak": traced_peak,
+    }
+    if not started_tracing:
+        memory["top"] = [str(s) for s in after.statistics('lineno')[:top_n]]
+
+    queued_jobs = None
+    if SCHEDULER:
+        with SCHEDULER.cond:
+            queued_jobs = sum(1 for lane in SCHEDULER.lanes.values() for job in lane if job.tenant is tenant)
+    threads = {}
+    for ident, frame in sys._current_frames().items():
+        name = names.get(ident, str(ident))
+        if ident != me and name not in hidden:
+            threads[name] = traceback.format_stack(frame)
+    profile = {
+        "server_id": tenant.server_id,
+        "version": AGENT_VERSION,
+        "compiled": AGENT_COMPILED,
+        "seconds": round(elapsed, 1),
+        "interval": interval,
+        "samples": samples,
+        "top_self": own.most_common(top_n),
+        "top_total": total.most_common(top_n),
+        "stacks": dict(stacks),
+        "threads": threads,
+        "memory": memory,
+        "job_memory": BUDGET.snapshot(tenant),
+        "queued_jobs": queued_jobs,
+    }
+    if AGENT_COMPILED:
+        profile["note"] = ("Agent is Cython-compiled: its own functions are not sampled and their "
+                           "allocations are attributed to the nearest Python caller")
+    return profile
+
+def upload_profile(seconds=PROFILE_DEFAULT_SECONDS, tenant=None, interval=PROFILE_INTERVAL):
+    tenant = tenant or TENANTS[0]
+    if not PROFILE_LOCK.acquire(blocking=False):
+        logger.warning(f"{tenant.tag}Profile requested while another capture is running; ignoring")
+        return
+    try:
+        try:
+            seconds = min(max(float(seconds), 1), PROFILE_MAX_SECONDS)
+            interval = max(float(interval), 0.001)
+        except (TypeError, ValueError):
+            seconds, interval = PROFILE_DEFAULT_SECONDS, PROFILE_INTERVAL
+        logger.info(f"{tenant.tag}Capturing {seconds:.0f}s profile (sampling every {interval * 1000:.0f}ms)")
+        if AGENT_COMPILED:
+            logger.info(f"{tenant.tag}Compiled build: the profile shows library frames only, not the agent's own functions")
+        profile = capture_profile(seconds, interval, PROFILE_TOP_N, tenant=tenant)
+        body = gzip.compress(json.dumps(profile).encode())
+        headers = dict(tenant.headers, **{"Content-Type": "application/json", "Content-Encoding": "gzip"})
+        HTTP.post(f"{tenant.api}/api/agent/upload_profile", data=body, headers=headers, timeout=60)
+        logger.info(f"{tenant.tag}Profile uploaded ({profile['samples']} samples, {len(body)} bytes compressed)")
+    except Exception as e:
+        logger.error(f"{tenant.tag}Failed to capture or upload profile: {e}")
+    finally:
+        PROFILE_LOCK.release()
+
+
+# Filter out virtual/software printers that can't physically print
+VIRTUAL_PRINTER_KEYWORDS = ['pdf', 'microsoft print', 'onenote', 'xps', 'fax',
+                            'send to', 'one note', 'document writer', 'adobe pdf']
+
+def is_virtual_printer(name):
+    return any(kw in name.lower() for kw in VIRTUAL_PRINTER_KEYWORDS)
+
+def simulated_printer_entry(uid="simulated-printer", name="Simulated Label Printer"):
+    return {
+        "uid": uid, 
+        "name": name, 
+        "status": "online",
+        "properties": {
+            "orientation": "portrait", 
+            "color": "monochrome", 
+            "duplex": "simplex",
+            "has_color": False,
+            "supported_papers": ["A4", "A5", "Letter"],
+            "supported_bins": ["Manual Feed", "Tray 1"]
+        }
+    }
+
+def build_printer_entry(name):
+    # Capability scans are slow; tenants and repeated syncs share one scan per printer.
+    # Only the status is refreshed on a cache hit.
+    now = time.time()
+    with CAPABILITY_LOCK:
+        cached = CAPABILITY_CACHE.get(name)
+    if cached and now - cached[0] < CAPABILITY_CACHE_TTL:
+        return dict(cached[1], status=get_printer_health(name)[0])
+    entry = scan_printer_entry(name)
+    with CAPABILITY_LOCK:
+        CAPABILITY_CACHE[name] = (now, entry)
+    return entry
+
+def refresh_printer_status(name):
+    # A status change says nothing about capabilities: reuse the cached entry however old it is
+    with CAPABILITY_LOCK:
+        cached = CAPABILITY_CACHE.get(name)
+    if cached is None:
+        return build_printer_entry(name)
+    return dict(cached[1], status=get_printer_health(name)[0])
+
+def invalidate_capabilities(names=None):
+    with CAPABILITY_LOCK:
+        if names is None:
+            CAPABILITY_CACHE.clear()
+        for name in names or []:
+            CAPABILITY_CACHE.pop(name, None)
+
+def scan_printer_entry(name):
+    if DEV_MODE:
+        return simulated_printer_entry(name, name)
+    props = get_printer_properties(name)
+    presets = get_all_presets(name)
+
+    # Fallback: if get_all_presets returned no paper presets (driver bug / DC_PAPERNAMES failure),
+    # build basic paper presets from the supported_papers captured by get_printer_properties.
+    # These will have no width/height dimensions but at least names will be synced to SaaS.
+    paper_preset_names = {p['name'] for p in presets if p.get('preset_type') == 'paper'}
+    missing_papers = [pn for pn in props.get('supported_papers', []) if pn not in paper_preset_names]
+    if missing_papers:
+        logger.warning(f"{printer_tag(name)}  - get_all_presets returned no paper presets for {name}, using fallback for {len(missing_papers)} papers")
+        for paper_name in missing_papers:
+            presets.append({
+                "printer_name": name,
+                "preset_type":  "paper",
+                "name":         paper_name,
+                "code":         0,
+                "width_mm":     None,
+                "height_mm":    None,
+                "bin_name":     None,
+                "bin_id":       None,
+            })
+
+    # Use real Windows spooler status from properties
+    real_status = props.get('hw_status', 'online')
+    return {
+        "uid": name,
+        "name": name,
+        "status": real_status,
+        "properties": props,
+        "presets": presets
+    }
+
+def post_printers(printers, icon=None, tenant=None, **extra):
+    tenant = tenant or TENANTS[0]
+    payload = {
+        "printers": [p for p in printers if tenant.allows(p["uid"])],
+        "server_uid": tenant.server_id,
+        "os_user": getpass.getuser(),
+        "os_name": get_os_display_name()
+    }
+    payload.update(extra)
+    response = HTTP.post(f"{tenant.api}/api/agent/printers", json=payload, headers=tenant.headers, timeout=60)
+    if response.status_code == 200: 
+        logger.info(f"{tenant.tag}Successfully reported printers to SaaS")
+        if icon:
+            update_status(icon, f"{tenant.tag}Online")
+    else: 
+        logger.error(f"{tenant.tag}Failed to report printers: HTTP {response.status_code} - {response.text}")
+        if icon:
+            update_status(icon, f"{tenant.tag}Error {response.status_code}")
+    return response.status_code == 200
 
-def sync_printers(icon=None):
+def sync_printers(icon=None, tenant=None):
+    # Discovery runs once and is reported to the given tenant, or to every tenant.
+    # A sync is an explicit request for fresh data, so cached capabilities are dropped;
+    # the cache still saves the other tenants a scan within this discovery.
+    tenants = [tenant] if tenant else TENANTS
+    invalidate_capabilities()
     try:
-        logger.info(f"Starting printer discovery (Server: {SERVER_ID}, API: {API})...")
+        for t in tenants:
+            logger.info(f"{t.tag}Starting printer discovery (Server: {t.server_id})...")
         if DEV_MODE:
             logger.info("Running in Simulation mode")
-            discovered_printers = [{
-                "uid": "simulated-printer", 
-                "name": "Simulated Label Printer", 
-                "status": "online",
-                "properties": {
-                    "orientation": "portrait", 
-                    "color": "monochrome", 
-                    "duplex": "simplex",
-                    "has_color": False,
-                    "supported_papers": ["A4", "A5", "Letter"],
-                    "supported_bins": ["Manual Feed", "Tray 1"]
-                }
-            }]
+            discovered_printers = [simulated_printer_entry()]
         else:
             printers = win32print.EnumPrinters(win32print.PRINTER_ENUM_LOCAL | win32print.PRINTER_ENUM_CONNECTIONS)
             logger.info(f"Found {len(printers)} printers in Windows spooler")
             discovered_printers = []
 
-            # Filter out virtual/software printers that can't physically print
-            virtual_kw = ['pdf', 'microsoft print', 'onenote', 'xps', 'fax',
-                          'send to', 'one note', 'document writer', 'adobe pdf']
-
             for p in printers:
                 name = p[2]
-                if any(kw in name.lower() for kw in virtual_kw):
+                if is_virtual_printer(name):
                     logger.info(f"  - Skipping virtual printer: {name}")
                     continue
-                props = get_printer_properties(name)
-                presets = get_all_presets(name)
-
-                # Fallback: if get_all_presets returned no paper presets (driver bug / DC_PAPERNAMES failure),
-                # build basic paper presets from the supported_papers captured by get_printer_properties.
-                # These will have no width/height dimensions but at least names will be synced to SaaS.
-                paper_preset_names = {p['name'] for p in presets if p.get('preset_type') == 'paper'}
-                missing_papers = [pn for pn in props.get('supported_papers', []) if pn not in paper_preset_names]
-                if missing_papers:
-                    logger.warning(f"  - get_all_presets returned no paper presets for {name}, using fallback for {len(missing_papers)} papers")
-                    for paper_name in missing_papers:
-                        presets.append({
-                            "printer_name": name,
-                            "preset_type":  "paper",
-                            "name":         paper_name,
-                            "code":         0,
-                            "width_mm":     None,
-                            "height_mm":    None,
-                            "bin_name":     None,
-                            "bin_id":       None,
-                        })
+                discovered_printers.append(build_printer_entry(name))
 
-                # Use real Windows spooler status from properties
-                real_status = props.get('hw_status', 'online')
-                discovered_printers.append({
-                    "uid": name,
-                    "name": name,
-                    "status": real_status,
-                    "properties": props,
-                    "presets": presets
-                })
+        # Pools are advertised as printers of their own so jobs can target the pool uid
+        for pool in PRINTER_POOLS.values():
+            member = next((p for p in discovered_printers if p["uid"] in pool.members), None)
+            discovered_printers.append({
+                "uid": pool.name,
+                "name": f"{pool.name} (Pool of {len(pool.members)})",
+                "status": pool.status(),
+                "properties": member["properties"] if member else {},
+                "presets": member.get("presets", []) if member else [],
+                "pool_members": pool.members
+            })
 
-        payload = {
-            "printers": discovered_printers,
-            "server_uid": SERVER_ID,
-            "os_user": getpass.getuser(),
-            "os_name": get_os_display_name()
-        }
         logger.info(f"Reporting {len(discovered_printers)} printers to SaaS...")
-        response = requests.post(f"{API}/api/agent/printers", json=payload, headers=HEADERS, timeout=60)
-        if response.status_code == 200: 
-            logger.info("Successfully reported printers to SaaS")
-            if icon:
-                update_status(icon, "Online")
-        else: 
-            logger.error(f"Failed to report printers: HTTP {response.status_code} - {response.text}")
-            if icon:
-                update_status(icon, f"Error {response.status_code}")
+        for t in tenants:
+            try:
+                post_printers(discovered_printers, icon, tenant=t)
+            except Exception as e:
+                logger.error(f"{t.tag}Failed to report printers: {e}")
+                if icon:
+                    update_status(icon, f"{t.tag}Offline")
     except Exception as e:
         logger.critical(f"CRITICAL ERROR in printer discovery: {e}")
         if icon:
             update_status(icon, "Offline")
 
+def sync_printer_changes(changed, removed, icon=None, status_changed=()):
+    # Incremental update: only re-scan printers whose configuration changed.
+    # Status-only changes reuse the cached capabilities and only refresh the status.
+    invalidate_capabilities(list(changed) + list(removed))
+    try:
+        logger.info(f"Reporting spooler changes to SaaS: {len(changed)} added/changed, {len(status_changed)} status, {len(removed)} removed")
+        entries = [build_printer_entry(name) for name in changed]
+        entries += [refresh_printer_status(name) for name in status_changed]
+    except Exception as e:
+        logger.error(f"Failed to scan changed printers: {e}")
+        return
+    for tenant in TENANTS:
+        try:
+            post_printers(entries, icon, tenant=tenant, incremental=True,
+                          removed=[name for name in removed if tenant.allows(name)])
+        except Exception as e:
+            logger.error(f"{tenant.tag}Failed to report printer changes: {e}")
+
+class SpoolerEvents(abc.ABC):
+    """Source of local spooler change notifications.
+
+    wait(timeout) returns True once something changed (False on timeout) and
+    snapshot() returns {printer name: (configuration, status)} for the physical
+    printers. Only a configuration change warrants a capability re-scan.
+    """
+    @abc.abstractmethod
+    def wait(self, timeout):
+        pass
+
+    @abc.abstractmethod
+    def snapshot(self):
+        pass
+
+    def close(self):
+        pass
+
+class Win32SpoolerEvents(SpoolerEvents):
+    # FindFirstPrinterChangeNotification on the local print server handle
+    def __init__(self):
+        self.server = win32print.OpenPrinter(None)
+        self.change = win32print.FindFirstPrinterChangeNotification(
+            self.server, PRINTER_CHANGE_PRINTER | PRINTER_CHANGE_PRINTER_DRIVER, 0, None)
+
+    def wait(self, timeout):
+        if win32event.WaitForSingleObject(self.change, int(timeout * 1000)) != win32event.WAIT_OBJECT_0:
+            return False
+        win32print.FindNextPrinterChangeNotification(self.change, None)  # Re-arms the notification
+        return True
+
+    def snapshot(self):
+        state = {}
+        for info in win32print.EnumPrinters(win32print.PRINTER_ENUM_LOCAL | win32print.PRINTER_ENUM_CONNECTIONS, None, 2):
+            name = info['pPrinterName']
+            if is_virtual_printer(name):
+                continue
+            dm = info.get('pDevMode')
+            config = (info.get('pDriverName'), info.get('pPortName'), info.get('pLocation'), info.get('pComment'),
+                      (dm.Orientation, dm.PaperSize, dm.Color, dm.Duplex) if dm else None)
+            # online <-> printing flips twice per job; only real availability changes are worth a push
+            status = decode_printer_status(info.get('Status', 0))
+            state[name] = (config, 'online' if status == 'printing' else status)
+        return state
+
+    def close(self):
+        try:
+            win32print.FindClosePrinterChangeNotification(self.change)
+            win32print.ClosePrinter(self.server)
+        except Exception:
+            pass
+
+class FakeSpoolerEvents(SpoolerEvents):
+    """In-memory spooler for simulation mode and non-Windows hosts; add/remove/change fire events."""
+    def __init__(self, printers=None):
+        self.printers = dict(printers or {})
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+
+    def add(self, name, state="online", config=None):
+        with self.lock:
+            self.printers[name] = (config, state)
+        self.event.set()
+
+    def change(self, name, state=None, config=None):
+        with self.lock:
+            old_config, old_state = self.printers.get(name, (None, "online"))
+            self.printers[name] = (old_config if config is None else config, old_state if state is None else state)
+        self.event.set()
+
+    def remove(self, name):
+        with self.lock:
+            self.printers.pop(name, None)
+        self.event.set()
+
+    def wait(self, timeout):
+        fired = self.event.wait(timeout)
+        self.event.clear()
+        return fired
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.printers)
+
+def make_spooler_events():
+    if DEV_MODE or win32print is None:
+        return FakeSpoolerEvents({"simulated-printer": (None, "online")})
+    return Win32SpoolerEvents()
+
+class PrinterWatcher(object):
+    """Diffs spooler snapshots on every change notification and pushes only the delta."""
+    def __init__(self, backend, push=None, icon=None):
+        self.backend = backend
+        self.push = push or sync_printer_changes
+        self.icon = icon
+        self.running = False
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.run, name="PrinterWatcher", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        known = self.backend.snapshot()
+        logger.info(f"Watching spooler for printer changes ({len(known)} printers)")
+        try:
+            while self.running:
+                if not self.backend.wait(1.0):
+                    continue
+                # A driver install fires a burst of notifications; settle before diffing
+                settle_until = time.monotonic() + SPOOLER_DEBOUNCE * 10
+                while time.monotonic() < settle_until and self.backend.wait(SPOOLER_DEBOUNCE):
+                    pass
+                current = self.backend.snapshot()
+                changed = [n for n, (config, _) in current.items() if n not in known or known[n][0] != config]
+                status_changed = [n for n, (config, status) in current.items()
+                                  if n in known and known[n][0] == config and known[n][1] != status]
+                removed = [n for n in known if n not in current]
+                known = current
+                if changed or removed or status_changed:
+                    self.push(changed, removed, self.icon, status_changed=status_changed)
+        except Exception as e:
+            logger.error(f"Printer watcher stopped, falling back to server-requested syncs: {e}")
+        finally:
+            self.backend.close()
+
+def parse_deadline(value):
+    # Server sends either epoch seconds or an ISO 8601 timestamp (naive = UTC, as Odoo stores them)
+    if value in (None, "", False):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        dt = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.timestamp()
+    except ValueError:
+        logger.warning(f"Ignoring unparseable job deadline: {value}")
+        return None
+
+def is_raw_format(data):
+    return data.get("format") in ["raw", "zpl"]
+
+def job_printers(data):
+    # Printer uids a job addresses: its fan-out targets, or the single printer_uid
+    targets = data.get('targets')
+    if not targets:
+        return [data.get('printer_uid')]
+    return [t.get('printer_uid') if isinstance(t, dict) else t for t in targets]
+
+def invalid_job(data):
+    # Shape check before anything is decoded or queued; returns an error message or None
+    if not isinstance(data, dict):
+        return "body must be a JSON object"
+    if not isinstance(data.get('content'), str) or not data['content']:
+        return "content must be a non-empty base64 string"
+    if not isinstance(data.get('job_id', ""), (str, int)) or isinstance(data.get('job_id'), bool):
+        return "job_id must be a string or integer"
+    if 'targets' in data:
+        targets = data['targets']
+        if not isinstance(targets, list) or not targets:
+            return "targets must be a non-empty list"
+        for target in targets:
+            uid = target.get('printer_uid') if isinstance(target, dict) else target
+            if not isinstance(uid, str) or not uid:
+                return "each target must be a printer uid or an object with a printer_uid string"
+    elif not isinstance(data.get('printer_uid'), str) or not data['printer_uid']:
+        return "printer_uid (or targets) is required"
+    return None
+
+def report_job_status(job_id, status, error=None, tenant=None, **extra):
+    tenant = tenant or TENANTS[0]
+    payload = {"job_id": job_id, "status": status}
+    if error:
+        payload["error"] = error
+    payload.update(extra)
+    try:
+        HTTP.post(f"{tenant.api}/api/jobs/status", json=payload, headers=tenant.headers, timeout=30)
+    except Exception as e:
+        logger.error(f"{tenant.tag}Failed to report status '{status}' for job {job_id}: {e}")
+
+def print_jobs(jobs):
+    # Prints one copy of every job in the batch with a single engine call.
+    # The scheduler only batches PDF jobs for the same printer with identical settings.
+    job = jobs[0]
+    data = job.data
+    if job.is_raw:
+        logger.info(f"{join_tags(j.tag for j in jobs)}Processing RAW/ZPL job...")
+        print_raw_data(job.raw_data(), job.printer, should_cancel=job.cancelled.is_set)
+    else:
+        logger.info(f"{join_tags(j.tag for j in jobs)}Processing PDF job: Orientation={data.get('orientation')}, Bin={data.get('bin_name')}" + (f" (coalesced with {len(jobs) - 1} more)" if len(jobs) > 1 else ""))
+        print_pdf_files([j.spool_file() for j in jobs], job.printer, job.print_settings(),
+                        should_cancel=lambda: any(j.cancelled.is_set() for j in jobs))
+
+class PrinterPool(object):
+    """Identical printers addressed by one uid; each job goes to the least-loaded healthy member."""
+    def __init__(self, name, members):
+        self.name = name
+        self.members = members
+        self.failed_until = {}   # member -> time until which it is skipped after a print failure
+        self.lock = threading.Lock()
+
+    def mark_failed(self, member):
+        with self.lock:
+            self.failed_until[member] = time.time() + POOL_FAILOVER_COOLDOWN
+
+    def pick(self, exclude=(), healthy_only=False):
+        # Load = spooler queue depth + jobs this agent still has queued for the member
+        now = time.time()
+        healthy, fallback = [], []
+        for index, member in enumerate(self.members):
+            if member in exclude:
+                continue
+            status, spooled = get_printer_health(member)
+            load = spooled + (SCHEDULER.pending_count(member) if SCHEDULER else 0)
+            with self.lock:
+                cooling = self.failed_until.get(member, 0) > now
+            if status in PRINTER_READY_STATES and not cooling:
+                healthy.append((load, index, member))
+            else:
+                fallback.append((load, index, member))
+        if healthy:
+            return min(healthy)[2]
+        if fallback and not healthy_only:
+            # Nothing healthy: still route the job rather than drop it
+            logger.warning(f"{printer_tag(self.name)}No healthy member in pool {self.name}, using least-loaded member anyway")
+            return min(fallback)[2]
+        return None
+
+    def status(self):
+        statuses = [get_printer_health(m)[0] for m in self.members]
+        if any(s in PRINTER_READY_STATES for s in statuses):
+            return 'online'
+        return statuses[0] if statuses else 'offline'
+
+class SharedPayload(object):
+    """A job's decoded document, shared by every PrintJob that prints it.
+
+    The base64 content is decoded at most once per form (spool file for PDF,
+    bytes for RAW) and the temp file is removed when the last holder releases it.
+    """
+    def __init__(self, content, refs=1, suffix=".pdf", tenant=None):
+        self.content = content or ""
+        self.refs = refs
+        self.suffix = suffix
+        self.tenant = tenant     # Whose share of BUDGET this payload counts against
+        self.spool_path = None
+        self.raw_bytes = None
+        self.lock = threading.Lock()
+        self.charged = 0         # base64 bytes counted against BUDGET
+        headroom = BUDGET.headroom(tenant)
+        if len(self.content) > MEMORY_SPILL_BYTES or (headroom is not None and len(self.content) > headroom):
+            # Too big to keep, or no room left: go to disk now and drop the in-memory base64
+            self._spool()
+            logger.info(f"Spilled {os.path.getsize(self.spool_path)} byte job payload to disk")
+        else:
+            self.charged = len(self.content)
+            BUDGET.charge('payload', self.charged, self.tenant)
+
+    def _spool(self):
+        # Caller holds self.lock (or is __init__)
+        if self.spool_path is None:
+            self.spool_path = write_spool_file(self.content, self.suffix)
+            BUDGET.credit('payload', self.charged, self.tenant)
+            self.content, self.charged = None, 0
+        return self.spool_path
+
+    def spool_file(self):
+        with self.lock:
+            return self._spool()
+
+    def raw_data(self):
+        # bytes for payloads held in memory; a SpooledRaw (iterable of chunks) once
+        # spilled, so a large RAW job never comes back into RAM whole
+        with self.lock:
+            if self.content is None:
+                return SpooledRaw(self.spool_path)
+            if self.raw_bytes is None:
+                # Strip any trailing whitespace or command delimiters that cause blank pages
+                self.raw_bytes = base64.b64decode(self.content).strip(RAW_STRIP)
+                BUDGET.charge('print', len(self.raw_bytes), self.tenant)
+            return self.raw_bytes
+
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            if self.refs > 0:
+                return
+            BUDGET.credit('payload', self.charged, self.tenant)
+            if self.raw_bytes is not None:
+                BUDGET.credit('print', len(self.raw_bytes), self.tenant)
+            self.content = self.raw_bytes = None
+            self.charged = 0
+            path, self.spool_path = self.spool_path, None
+        if path:
+            try: os.unlink(path)
+            except: pass
+
+class SpooledRaw(object):
+    """A spilled RAW document, read back in RAW_CHUNK pieces instead of all at once.
+
+    Leading and trailing RAW_STRIP bytes are skipped, as bytes.strip() does for
+    in-memory jobs.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _bounds(self, f):
+        size = os.fstat(f.fileno()).st_size
+        start = 0
+        while start < size:
+            f.seek(start)
+            block = f.read(RAW_CHUNK)
+            skipped = len(block) - len(block.lstrip(RAW_STRIP))
+            start += skipped
+            if skipped < len(block):
+                break
+        end = size
+        while end > start:
+            n = min(RAW_CHUNK, end - start)
+            f.seek(end - n)
+            block = f.read(n)
+            skipped = len(block) - len(block.rstrip(RAW_STRIP))
+            end -= skipped
+            if skipped < len(block):
+                break
+        return start, end
+
+    def __iter__(self):
+        with open(self.path, "rb") as f:
+            start, end = self._bounds(f)
+            f.seek(start)
+            while start < end:
+                chunk = f.read(min(RAW_CHUNK, end - start))
+                if not chunk:
+                    break
+                start += len(chunk)
+                yield chunk
+
+class PrintJob(object):
+    def __init__(self, data, seq, tenant=None, payload=None, fanout=None):
+        self.data = data
+        self.payload = payload or SharedPayload(data.pop("content", ""), suffix=".prn" if is_raw_format(data) else ".pdf",
+                                                    tenant=tenant)
+        self.fanout = fanout     # FanOutJob this job is one target of, if any
+        self.tenant = tenant
+        self.tag = tenant.tag if tenant else ""
+        self.source = data.get('source')     # 'local' for jobs submitted through the local API
+        self.job_id = data.get('job_id')
+        self.target = data.get('printer_uid')
+        self.printer = self.target      # Physical printer; differs from target for pooled jobs
+        self.pool = PRINTER_POOLS.get(self.target)
+        self.tried = set()
+        try: self.priority = int(data.get('priority') or 0)
+        except (TypeError, ValueError): self.priority = 0
+        self.deadline = parse_deadline(data.get('deadline'))
+        try: self.copies = max(int(data.get('copies') or 1), 1)
+        except (TypeError, ValueError): self.copies = 1
+        self.copies_done = 0
+        self.status = None       # Final status other than 'done': error / timeout / cancelled
+        self.error = None
+        self.cancelled = threading.Event()
+        self.held = False        # Already reported as 'held' for the current outage
+        self.seq = seq
+        self.received_at = time.time()
+        self.is_raw = is_raw_format(data)
+        self.released = False
+
+    def print_settings(self):
+        data = self.data
+        return build_print_settings(data.get("orientation", "portrait"), data.get("color_mode"),
+                                    data.get("duplex_mode"), data.get("paper_size"), data.get("bin_name"))
+
+    def batch_key(self):
+        # PDF jobs sharing a key can go to SumatraPDF in one invocation
+        return None if self.is_raw else self.print_settings()
+
+    def spool_file(self):
+        # Decoded and written once, then reused for every copy and every fan-out target
+        return self.payload.spool_file()
+
+    def raw_data(self):
+        return self.payload.raw_data()
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.payload.release()
+
+    @property
+    def finished(self):
+        return self.status is not None or self.copies_done >= self.copies
+
+    def sort_key(self, now):
+        # A job about to miss its deadline jumps ahead of everything, then higher
+        # priority first, then earliest deadline, then arrival order.
+        urgent = self.deadline is not None and self.deadline - now <= DEADLINE_SLACK
+        deadline = self.deadline if self.deadline is not None else float('inf')
+        return (0 if urgent else 1, -self.priority, deadline, self.seq)
+
+class FanOutJob(object):
+    """One document printed to several printers.
+
+    The server sends a single job with a ``targets`` list instead of N copies of
+    the payload. Each target is an ordinary PrintJob in its own printer lane, so
+    targets print in parallel; their results come back here and are reported to
+    the server in one status batch once the last target finishes.
+    """
+    def __init__(self, data, tenant=None):
+        self.data = data
+        self.tenant = tenant
+        self.tag = tenant.tag if tenant else ""
+        self.job_id = data.get('job_id')
+        self.source = data.get('source')
+        self.children = []
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def target_data(self, target):
+        # Targets are bare printer uids or dicts of per-target overrides (copies, paper_size, ...)
+        overrides = target if isinstance(target, dict) else {"printer_uid": target}
+        data = {k: v for k, v in self.data.items() if k not in ("targets", "content")}
+        data.update(overrides)
+        return data
+
+    def child_finished(self):
+        with self.lock:
+            self.pending -= 1
+            return self.pending == 0
+
+    @property
+    def finished(self):
+        return all(child.finished for child in self.children)
+
+    def summary(self):
+        results = [{"printer_uid": c.target, "printer_used": c.printer, "status": c.status or "done",
+                    "error": c.error} for c in self.children]
+        failed = [r for r in results if r["status"] != "done"]
+        if not failed:
+            status = "done"
+        elif len(failed) == len(results):
+            # Every target failed: keep a shared status (all timeouts, all cancelled), else 'error'
+            statuses = {r["status"] for r in failed}
+            status = statuses.pop() if len(statuses) == 1 else "error"
+        else:
+            status = "partial"
+        error = f"{len(failed)} of {len(results)} targets failed" if failed else None
+        return status, error, results
+
+class JobScheduler(object):
+    """Per-printer job lanes drained by a small pool of worker threads.
+
+    A job prints one copy per dispatch and then goes back into its lane, so a
+    300-copy report yields to an urgent label between copies. Compatible PDF
+    jobs queued for the same printer are printed together in one dispatch.
+    Jobs for an offline or jammed printer are held until it recovers.
+    """
+    def __init__(self, workers=SCHEDULER_WORKERS, execute=None, report=None, health=None):
+        self.workers = max(1, workers)
+        self.execute = execute or print_jobs
+        self.report = report or report_job_status
+        self.health = health or get_printer_health
+        self.lanes = {}          # printer -> [PrintJob]
+        self.busy = set()        # printers a worker is currently driving
+        self.running_jobs = set()
+        self.last_served = {}    # printer -> monotonic time of last dispatch
+        self.tenant_served = {}  # tenant -> monotonic time of its last dispatch (gateway round-robin)
+        self.held = {}           # printer -> status that made us park its lane
+        self.release_at = {}     # printer -> monotonic time of its next throttled dispatch
+        self.release_budget = {} # printer -> held jobs still to be released under throttling
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.running = False
+
+    def start(self):
+        self.running = True
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"PrintWorker-{i + 1}", daemon=True).start()
+        threading.Thread(target=self._hold_monitor, name="HoldMonitor", daemon=True).start()
+        logger.info(f"Job scheduler started with {self.workers} workers")
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    def submit(self, data, tenant=None):
+        if data.get('targets'):
+            return self.submit_fanout(data, tenant)
+        with self.cond:
+            self.seq += 1
+            job = PrintJob(data, self.seq, tenant)
+        return self._enqueue(job)
+
+    def submit_fanout(self, data, tenant=None):
+        # The payload is decoded once and shared; each target gets its own lane entry
+        group = FanOutJob(data, tenant)
+        targets = data['targets']
+        payload = SharedPayload(data.pop('content', ""), refs=len(targets),
+                                suffix=".prn" if is_raw_format(data) else ".pdf", tenant=tenant)
+        with self.cond:
+            for target in targets:
+                self.seq += 1
+                group.children.append(PrintJob(group.target_data(target), self.seq, tenant, payload, group))
+        group.pending = len(group.children)
+        logger.info(f"{group.tag}Fan-out job {group.job_id} to {len(targets)} printers: {', '.join(c.target for c in group.children)}")
+        for job in group.children:
+            self._enqueue(job)
+        return group
+
+    def _enqueue(self, job):
+        data = job.data
+        if job.pool:
+            job.printer = job.pool.pick() or job.target
+            logger.info(f"{job.tag}Pool {job.target}: routing job {job.job_id} to {job.printer}")
+        with self.cond:
+            self.lanes.setdefault(job.printer, []).append(job)
+            hold_status = self.held.get(job.printer)
+            job.held = hold_status is not None
+            self.cond.notify_all()
+        logger.info(f"{job.tag}Job {job.job_id} queued for {job.printer} (priority={job.priority}, deadline={data.get('deadline')}, copies={job.copies})")
+        if job.held:
+            self._report_held(job, hold_status)
+        return job
+
+    def cancel(self, job_id, tenant=None):
+        # Queued jobs are dropped at once; running ones are killed by their watchdog.
+        # Job ids are only unique per tenant; every target of a fan-out job shares its id.
+        dropped = []
+        with self.cond:
+            jobs = [j for lane in self.lanes.values() for j in lane
+                    if str(j.job_id) == str(job_id) and (tenant is None or j.tenant is tenant)]
+            if not jobs:
+                return False
+            for job in jobs:
+                job.cancelled.set()
+                if job in self.running_jobs:
+                    logger.info(f"{job.tag}Cancelling running job {job_id} on {job.printer}")
+                    continue
+                lane = self.lanes.get(job.printer, [])
+                if job in lane: lane.remove(job)
+                if not lane: self.lanes.pop(job.printer, None)
+                dropped.append(job)
+        for job in dropped:
+            logger.info(f"{job.tag}Cancelled queued job {job_id} on {job.printer}")
+            job.status, job.error = 'cancelled', "Cancelled by server"
+            job.release()
+            self._report(job)
+        return True
+
+    def job_state(self, job):
+        if isinstance(job, FanOutJob):
+            if job.finished:
+                return job.summary()[0]
+            states = {self.job_state(child) for child in job.children}
+            return "printing" if "printing" in states else ("held" if states == {"held"} else "queued")
+        if job.finished:
+            return job.status or "done"
+        with self.cond:
+            if job in self.running_jobs:
+                return "printing"
+        return "held" if job.held else "queued"
+
+    def pending_count(self, printer):
+        with self.cond:
+            return len(self.lanes.get(printer, ()))
+
+    def _pick(self):
+        # Caller holds self.cond. Choose the idle printer whose most urgent job ranks
+        # highest; ties go to the printer served least recently (fair share).
+        # Tenants take turns first: priorities and deadlines come from each tenant's own
+        # server, so they only order jobs within a tenant, never across tenants.
+        now = time.time()
+        best = None
+        for printer, jobs in self.lanes.items():
+            if not jobs or printer in self.busy or printer in self.held or is_printer_wedged(printer):
+                continue
+            if self.release_at.get(printer, 0) > time.monotonic():
+                continue
+            head = min(jobs, key=lambda j: (j.cancelled.is_set(), self.tenant_served.get(j.tenant, 0), j.sort_key(now)))
+            key = head.sort_key(now)
+            rank = (self.tenant_served.get(head.tenant, 0), key[0], key[1], self.last_served.get(printer, 0), key[2], key[3])
+            if best is None or rank < best[0]:
+                best = (rank, printer, head)
+        return (best[1], best[2]) if best else None
+
+    def _coalesce(self, printer, job):
+        # Caller holds self.cond. A fresh, non-urgent PDF job waits out the coalescing
+        # window so a burst of packing slips shares one engine start.
+        key = job.batch_key()
+        if key is None or COALESCE_MAX_JOBS <= 1:
+            return [job] if job in self.lanes.get(printer, []) else []
+        if job.sort_key(time.time())[0] != 0:
+            window_end = job.received_at + COALESCE_WINDOW
+            while self.running and time.time() < window_end:
+                self.cond.wait(window_end - time.time())
+        if job not in self.lanes.get(printer, []):
+            return []  # Cancelled while we waited
+        now = time.time()
+        others = [j for j in self.lanes.get(printer, [])
+                  if j is not job and j.tenant is job.tenant and j.batch_key() == key and not j.cancelled.is_set()]
+        others.sort(key=lambda j: j.sort_key(now))
+        return [job] + others[:COALESCE_MAX_JOBS - 1]
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                picked = self._pick()
+                while self.running and picked is None:
+                    # Timed wait so wedged and throttled lanes are re-checked
+                    next_release = min(self.release_at.values(), default=None)
+                    self.cond.wait(1 if next_release is None else min(1, max(0.05, next_release - time.monotonic())))
+                    picked = self._pick()
+                if not self.running:
+                    return
+                printer, job = picked
+                self.busy.add(printer)
+
+            # Check the spooler status before dispatch (outside the lock: it's a Win32 call)
+            status, _ = self.health(printer)
+            if status == PRINTER_MISSING:
+                self._fail_missing(printer)
+                continue
+            if status not in PRINTER_READY_STATES:
+                self._hold(printer, status)
+                continue
+
+            with self.cond:
+                self.last_served[printer] = time.monotonic()
+                self.tenant_served[job.tenant] = time.monotonic()
+                batch = self._coalesce(printer, job)
+                self.running_jobs.update(batch)
+                if printer in self.release_budget:
+                    # Recovered printer: drain held jobs at a limited rate
+                    self.release_budget[printer] -= len(batch)
+                    self.release_at[printer] = time.monotonic() + HOLD_RELEASE_INTERVAL
+                    if self.release_budget[printer] <= 0:
+                        self.release_budget.pop(printer, None)
+                        self.release_at.pop(printer, None)
+                if not batch:
+                    self.busy.discard(printer)
+                    self.cond.notify_all()
+                    continue
+
+            self._run_batch(batch)
+
+            finished = []
+            with self.cond:
+                self.busy.discard(printer)
+                self.running_jobs.difference_update(batch)
+                lane = self.lanes.get(printer, [])
+                for job in batch:
+                    if job.finished or job.printer != printer:
+                        if job in lane: lane.remove(job)
+                        if job.finished:
+                            finished.append(job)
+                        else:
+                            # Failed over to another pool member
+                            self.lanes.setdefault(job.printer, []).append(job)
+                if not lane: self.lanes.pop(printer, None)
+                self.cond.notify_all()
+
+            for job in finished:
+                job.release()
+                self._report(job)
+
+    def _report_fanout(self, group):
+        status, error, results = group.summary()
+        extra = {"source": group.source} if group.source else {}
+        self.report(group.job_id, status, error, tenant=group.tenant, targets=results, **extra)
+        logger.info(f"{group.tag}Fan-out job {group.job_id} finished: {status} ({len(results)} targets) and reported")
+
+    def _hold(self, printer, status):
+        # Park the printer's lane; pooled jobs move to a healthy member instead of waiting
+        with self.cond:
+            self.busy.discard(printer)
+            if printer not in self.held:
+                logger.warning(f"{printer_tag(printer)}Printer {printer} is {status}, holding its jobs until it recovers")
+            self.held[printer] = status
+            lane = list(self.lanes.get(printer, []))
+            self.cond.notify_all()
+
+        newly_held = []
+        for job in lane:
+            member = job.pool.pick(exclude=(printer,), healthy_only=True) if job.pool else None
+            with self.cond:
+                current = self.lanes.get(printer, [])
+                if job not in current:
+                    continue
+                if member:
+                    logger.info(f"{job.tag}Pool {job.target}: moving job {job.job_id} from held {printer} to {member}")
+                    current.remove(job)
+                    job.printer = member
+                    self.lanes.setdefault(member, []).append(job)
+                    self.cond.notify_all()
+                elif not job.held:
+                    job.held = True
+                    newly_held.append(job)
+                if not current:
+                    self.lanes.pop(printer, None)
+
+        for job in newly_held:
+            self._report_held(job, status)
+
+    def _fail_missing(self, printer):
+        # Holding is pointless for a printer that doesn't exist: pooled jobs try
+        # another member, everything else is reported as an error.
+        with self.cond:
+            self.busy.discard(printer)
+            lane = self.lanes.pop(printer, [])
+            self.cond.notify_all()
+        logger.error(f"{printer_tag(printer)}Printer {printer} not found, failing {len(lane)} queued jobs")
+        for job in lane:
+            job.tried.add(printer)
+            member = job.pool.pick(exclude=job.tried) if job.pool else None
+            if member:
+                logger.warning(f"{job.tag}Pool {job.target}: moving job {job.job_id} from missing {printer} to {member}")
+                job.printer = member
+                with self.cond:
+                    self.lanes.setdefault(member, []).append(job)
+                    self.cond.notify_all()
+                continue
+            job.status, job.error = 'error', f"Printer {printer} not found"
+            job.release()
+            self._report(job)
+
+    def _hold_monitor(self):
+        while self.running:
+            time.sleep(HOLD_CHECK_INTERVAL)
+            with self.cond:
+                printers = list(self.held)
+            for printer in printers:
+                status, _ = self.health(printer)
+                if status == PRINTER_MISSING:
+                    # Removed while its jobs were held
+                    with self.cond:
+                        self.held.pop(printer, None)
+                    self._fail_missing(printer)
+                    continue
+                if status not in PRINTER_READY_STATES:
+                    continue
+                with self.cond:
+                    self.held.pop(printer, None)
+                    lane = self.lanes.get(printer, [])
+                    released = [j for j in lane if j.held]
+                    for job in released:
+                        job.held = False
+                    if released:
+                        self.release_budget[printer] = len(released)
+                        self.release_at[printer] = 0
+                    self.cond.notify_all()
+                logger.info(f"{printer_tag(printer)}Printer {printer} is {status} again, releasing {len(released)} held jobs")
+
+    def _run_batch(self, batch):
+        # A job cancelled while queued behind its own earlier copy never reaches the engine
+        for job in batch:
+            if job.cancelled.is_set():
+                job.status, job.error = 'cancelled', "Cancelled by server"
+        batch = [job for job in batch if not job.cancelled.is_set()]
+        if not batch:
+            return
+        for job in batch:
+            if job.copies > 1:
+                logger.info(f"{job.tag}Printing copy {job.copies_done + 1} of {job.copies} for job {job.job_id}...")
+        try:
+            self.execute(batch)
+            for job in batch:
+                job.copies_done += 1
+                if job.cancelled.is_set() and not job.finished:
+                    # Cancelled mid-run: the current copy is out, the rest are dropped
+                    job.status, job.error = 'cancelled', "Cancelled by server"
+        except Exception as e:
+            # SumatraPDF keeps printing the rest of its file list after a bad file, so a
+            # failed batch is never re-run: that would print the good documents twice.
+            # The whole batch fails together; pooled jobs move on only for printer-side errors.
+            # Companions of a cancelled job stay queued and are retried.
+            status = 'timeout' if isinstance(e, JobTimeout) else 'error'
+            error = str(e) if len(batch) == 1 else f"{e} (printed in a batch of {len(batch)} documents; the failing one is unknown)"
+            logger.error(f"{join_tags(j.tag for j in batch)}Job execution failed: {error}")
+            for job in batch:
+                if job.cancelled.is_set():
+                    job.status, job.error = 'cancelled', "Cancelled by server"
+                elif isinstance(e, JobCancelled):
+                    continue
+                elif not self._failover(job, e):
+                    job.status, job.error = status, error
+
+    def _failover(self, job, error):
+        # Only a printer-side failure is worth another member; a bad document would fail
+        # on every member and bench the whole pool for POOL_FAILOVER_COOLDOWN.
+        if not job.pool or not is_printer_failure(error):
+            return False
+        job.tried.add(job.printer)
+        job.pool.mark_failed(job.printer)
+        member = job.pool.pick(exclude=job.tried)
+        if not member:
+            return False
+        logger.warning(f"{job.tag}Pool {job.target}: failing over job {job.job_id} from {job.printer} to {member}")
+        job.printer = member
+        return True
+
+    def _report_held(self, job, status):
+        extra = {"printer_uid": job.target} if job.fanout else {}
+        self.report(job.job_id, "held", f"Printer {job.printer} is {status}", tenant=job.tenant, **extra)
+
+    def _report(self, job):
+        if job.deadline is not None and time.time() > job.deadline:
+            logger.warning(f"{job.tag}Job {job.job_id} finished {int(time.time() - job.deadline)}s after its deadline")
+        if job.fanout:
+            # Targets report together once the last one is done
+            if job.fanout.child_finished():
+                self._report_fanout(job.fanout)
+            return
+        extra = {"printer_used": job.printer}
+        if job.source:
+            extra["source"] = job.source
+        if job.status is not None:
+            self.report(job.job_id, job.status, job.error, tenant=job.tenant, **extra)
+        else:
+            self.report(job.job_id, "done", tenant=job.tenant, **extra)
+            logger.info(f"{job.tag}Job {job.job_id} completed ({job.copies} copies) and reported")
+
+def parse_retry_after(value):
+    # Retry-After is either delta-seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class PollController(object):
+    """Paces the long-poll loop and keeps the connection-state report.
+
+    Failures back off with full jitter so a fleet reconnecting after a server
+    restart spreads out instead of arriving in lockstep. The server can
+    advertise its hold time (X-Poll-Hold) and ask for a pause (Retry-After);
+    a server answering empty polls immediately gets a growing idle delay.
+    """
+    def __init__(self):
+        self.hold = POLL_HOLD
+        self.failures = 0
+        self.idle_delay = 0.0
+        self.last_delay = 0.0
+        self.state = "connecting"
+        self.state_since = time.time()
+        self.last_error = None
+        self.counters = {"polls": 0, "jobs": 0, "empty": 0, "timeouts": 0, "errors": 0, "retry_after": 0}
+        self.latency_total = 0.0
+        self.last_report = time.monotonic()
+
+    def timeout(self):
+        # Server hold + network buffer
+        return self.hold + POLL_NETWORK_BUFFER
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            self.state_since = time.time()
+
+    def observe(self, response, elapsed):
+        self.counters["polls"] += 1
+        self.latency_total += elapsed
+        hold = response.headers.get("X-Poll-Hold")
+        if hold:
+            try:
+                self.hold = min(max(float(hold), 1.0), POLL_HOLD_MAX)
+            except ValueError:
+                pass
+
+    def on_success(self, got_work, elapsed):
+        # Returns the delay before the next poll
+        self.failures = 0
+        self._set_state("online")
+        if got_work:
+            self.counters["jobs"] += 1
+        else:
+            self.counters["empty"] += 1
+        if got_work or elapsed >= self.hold / 2:
+            # Either there is work or the server is holding connections: reconnect at once
+            self.idle_delay = 0.0
+        else:
+            # Server returned an empty poll right away (not long-polling): slow down gradually
+            self.idle_delay = min(POLL_IDLE_MAX, max(1.0, self.idle_delay * 2))
+        self.last_delay = random.uniform(self.idle_delay / 2, self.idle_delay) if self.idle_delay else 0.0
+        return self.last_delay
+
+    def on_timeout(self):
+        self.counters["timeouts"] += 1
+        return 0.0
+
+    def on_failure(self, error, retry_after=None):
+        self.failures += 1
+        self.counters["errors"] += 1
+        self.last_error = error
+        self._set_state("offline")
+        pause = parse_retry_after(retry_after)
+        if pause is not None:
+            # Honour the server's pause, spread over up to half of it again
+            self.counters["retry_after"] += 1
+            self.last_delay = pause + random.uniform(0, max(1.0, pause / 2))
+        else:
+            # Full jitter: uniform over [0, min(cap, base * 2^failures)]
+            self.last_delay = random.uniform(0, min(POLL_BACKOFF_CAP, POLL_BACKOFF_BASE * 2 ** self.failures))
+        return self.last_delay
+
+    def snapshot(self):
+        polls = self.counters["polls"]
+        snap = {
+            "state": self.state,
+            "state_for": int(time.time() - self.state_since),
+            "hold": self.hold,
+            "failures": self.failures,
+            "idle_delay": round(self.idle_delay, 1),
+            "last_delay": round(self.last_delay, 1),
+            "avg_latency": round(self.latency_total / polls, 2) if polls else None,
+            "last_error": self.last_error,
+        }
+        snap.update(self.counters)
+        return snap
+
+    def header(self):
+        # Compact per-poll report so the server can aggregate fleet connection behaviour
+        snap = self.snapshot()
+        return ";".join(f"{k}={snap[k]}" for k in ("state", "failures", "hold", "idle_delay", "last_delay"))
+
+    def maybe_report(self, tag=""):
+        if time.monotonic() - self.last_report >= POLL_REPORT_INTERVAL:
+            self.last_report = time.monotonic()
+            logger.info(f"{tag}Connection state: {self.snapshot()}")
+
+class LocalJobHandler(BaseHTTPRequestHandler):
+    # Accepts jobs in the same shape the poll delivers them:
+    #   POST /jobs        {"printer_uid": ..., "format": "pdf"|"raw", "content": <base64>, ...}
+    #                     (or "targets": [...] instead of printer_uid for a fan-out job)
+    #   GET  /jobs/<id>   local view of a job's state
+    #   GET  /health
+    # Every request needs "Authorization: Bearer <token>" (or X-Agent-Token).
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        logger.debug(f"Local API {self.address_string()}: {fmt % args}")
+
+    def _send(self, code, body):
+        payload = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _authorized(self):
+        auth = self.headers.get("Authorization", "")
+        token = auth[7:] if auth.startswith("Bearer ") else self.headers.get("X-Agent-Token", "")
+        return hmac.compare_digest(token.encode(), self.server.token.encode())
+
+    def do_GET(self):
+        if not self._authorized():
+            return self._send(401, {"error": "unauthorized"})
+        if self.path == "/health":
+            return self._send(200, {"status": "ok", "server_id": SERVER_ID})
+        if self.path.startswith("/jobs/"):
+            job = self.server.lookup(self.path[len("/jobs/"):])
+            if job is None:
+                return self._send(404, {"error": "unknown job"})
+            if isinstance(job, FanOutJob):
+                return self._send(200, {"job_id": job.job_id, "state": SCHEDULER.job_state(job),
+                                        "targets": [self._describe(c) for c in job.children]})
+            return self._send(200, dict(self._describe(job), job_id=job.job_id))
+        self._send(404, {"error": "not found"})
+
+    def _describe(self, job):
+        return {"printer_uid": job.target, "printer_used": job.printer, "state": SCHEDULER.job_state(job),
+                "error": job.error, "copies": job.copies, "copies_done": job.copies_done}
+
+    def do_POST(self):
+        if not self._authorized():
+            return self._send(401, {"error": "unauthorized"})
+        if self.path != "/jobs":
+            return self._send(404, {"error": "not found"})
+        try:
+            length = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            length = -1
+        if length < 0:
+            # rfile.read(-1) would block until the client hangs up, and a negative
+            # charge would switch the memory ceiling off
+            self.close_connection = True
+            return self._send(400, {"error": "missing or invalid Content-Length"})
+        if length > LOCAL_API_MAX_BYTES:
+            self.close_connection = True
+            return self._send(413, {"error": f"job larger than {LOCAL_API_MAX_BYTES} bytes"})
+        headroom = BUDGET.headroom()
+        if headroom is not None and length > headroom:
+            self.close_connection = True
+            return self._send(503, {"error": "agent is over its in-flight memory budget, retry later"})
+        BUDGET.charge('poll', length)
+        try:
+            try:
+                data = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                return self._send(400, {"error": "body is not valid JSON"})
+            code, body = self.server.submit(data)
+        finally:
+            BUDGET.credit('poll', length)
+        self._send(code, body)
+
+class LocalJobServer(ThreadingHTTPServer):
+    # Lets LAN applications hand jobs straight to the scheduler without the cloud round trip.
+    # Results are still reported to the server by the scheduler, tagged source=local.
+    daemon_threads = True
+    RECENT_JOBS = 1000
+
+    def __init__(self, bind, port, token):
+        super().__init__((bind, port), LocalJobHandler)
+        self.token = token
+        self.jobs = collections.OrderedDict()   # job_id -> PrintJob, most recent last
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="LocalAPI", daemon=True).start()
+        logger.info(f"Local job API listening on {self.server_address[0]}:{self.server_address[1]}")
+
+    def lookup(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def submit(self, data):
+        error = invalid_job(data)
+        if error:
+            return 400, {"error": error}
+        # In gateway mode the caller names the tenant the job is billed to
+        tenant_name = data.pop('tenant', None)
+        tenant = next((t for t in TENANTS if t.name == tenant_name), None) if tenant_name else TENANTS[0]
+        if tenant is None:
+            return 400, {"error": f"unknown tenant {tenant_name}"}
+        printers = job_printers(data)
+        if not all(tenant.allows(p) for p in printers):
+            return 403, {"error": "printer not available to this tenant"}
+        data['job_id'] = str(data.get('job_id') or f"local-{uuid.uuid4().hex[:12]}")
+        data['source'] = "local"
+        with self.lock:
+            if data['job_id'] in self.jobs and not self.jobs[data['job_id']].finished:
+                return 409, {"error": "job id already in progress"}
+        logger.info(f"{tenant.tag}Local job received: {data['job_id']} for {', '.join(map(str, printers))}")
+        try:
+            job = SCHEDULER.submit(data, tenant)
+        except Exception as e:
+            logger.error(f"{tenant.tag}Local job {data['job_id']} could not be queued: {e}")
+            return 500, {"error": f"could not queue job: {e}"}
+        with self.lock:
+            self.jobs[job.job_id] = job
+            self.jobs.move_to_end(job.job_id)
+            while len(self.jobs) > self.RECENT_JOBS:
+                self.jobs.popitem(last=False)
+        return 202, {"job_id": job.job_id, "state": SCHEDULER.job_state(job)}
+
+def start_local_api():
+    if not LOCAL_API_TOKEN:
+        logger.warning("Local job API enabled without a token; refusing to start it")
+        return None
+    try:
+        server = LocalJobServer(LOCAL_API_BIND, LOCAL_API_PORT, LOCAL_API_TOKEN)
+    except OSError as e:
+        logger.error(f"Local job API could not bind {LOCAL_API_BIND}:{LOCAL_API_PORT}: {e}")
+        return None
+    server.start()
+    return server
+
 def run_agent_loop(icon):
+    global SCHEDULER
+    configure_http(len(TENANTS) * 2 + SCHEDULER_WORKERS + 4)
+
     # 1. Initial Discovery
     sync_printers(icon)
 
-    # 2. Long-Poll Loop (replaces the 5s polling)
-    logger.info("Entering long-poll loop (server holds connection for ~25s per cycle)")
-    error_backoff = 1  # Start with 1s backoff on errors
+    # Jobs are printed by the scheduler's workers so the poll loop never blocks on a printer.
+    # In gateway mode every tenant shares these workers.
+    SCHEDULER = JobScheduler(SCHEDULER_WORKERS)
+    SCHEDULER.start()
+
+    # Push printer changes as the spooler reports them instead of waiting for a server sync
+    try:
+        PrinterWatcher(make_spooler_events(), icon=icon).start()
+    except Exception as e:
+        logger.warning(f"Spooler change notifications unavailable, relying on server-requested syncs: {e}")
+
+    if LOCAL_API_ENABLED:
+        start_local_api()
+
+    # 2. One long-poll loop per tenant
+    for tenant in TENANTS[1:]:
+        threading.Thread(target=poll_loop, args=(icon, tenant), name=f"Poll-{tenant.name}", daemon=True).start()
+    threading.current_thread().name = f"Poll-{TENANTS[0].name}"
+    poll_loop(icon, TENANTS[0])
+
+def poll_loop(icon, tenant):
+    poll = tenant.poll = PollController()
+    tag = tenant.tag
+    logger.info(f"{tag}Entering long-poll loop (server holds connection for ~{poll.hold}s per cycle)")
     while icon.visible:
+        delay = 0
+        if BUDGET.over(tenant):
+            # Over the memory ceiling (or this tenant's share): stop asking for jobs until
+            # printing frees some room. Servers that honour max_job_bytes are also told the
+            # remaining headroom below.
+            BUDGET.wait_for_room(1.0, tenant)
+            continue
         try:
-            # Long-poll: server holds this request for up to 25 seconds
-            # Timeout is 35s to allow 25s server hold + 10s network buffer
-            response = requests.get(f"{API}/api/agent/poll", headers=HEADERS, timeout=35)
+            # Long-poll: the server holds this request for up to poll.hold seconds
+            started = time.monotonic()
+            # Backpressure: only ask for jobs that fit in what is left of the memory budget
+            headroom = BUDGET.headroom(tenant)
+            response = HTTP.get(f"{tenant.api}/api/agent/poll", headers=dict(tenant.headers, **{"X-Agent-Poll-State": poll.header()}),
+                                params=None if headroom is None else {"max_job_bytes": headroom},
+                                timeout=poll.timeout())
+            poll.observe(response, time.monotonic() - started)
 
             if response.status_code == 200:
-                update_status(icon, "Online")
-                error_backoff = 1  # Reset backoff on success
-                data = response.json()
-
-                if data:
-                    # Check for remote log request
-                    if data.get('send_logs'):
-                        lines_to_get = data.get('log_lines', 100)
-                        threading.Thread(target=upload_logs, args=(lines_to_get,), daemon=True).start()
-
-                    # Check for printer sync request
-                    if data.get('sync_printers'):
-                        threading.Thread(target=sync_printers, args=(icon,), daemon=True).start()
-
-                    # Process print job if present
-                    if data.get('job_id'):
-                        job = data
-                        logger.info(f"New job received: {job.get('job_id')} for {job.get('printer_uid')}")
-                        icon.notify(f"Printing to {job.get('printer_uid')}", "New Print Job")
-                        
-                        copies = job.get('copies', 1)
-                        if copies < 1: copies = 1
-                        
-                        try:
-                            for i in range(copies):
-                                if copies > 1:
-                                    logger.info(f"Printing copy {i+1} of {copies}...")
-                                    
-                                if job.get("format") in ["raw", "zpl"]:
-                                    logger.info(f"Processing RAW/ZPL job...")
-                                    print_raw(job["content"], job["printer_uid"])
+                update_status(icon, f"{tag}Online")
+                # The body stays charged to the memory budget until its job is handed over
+                body_size = len(response.content)
+                BUDGET.charge('poll', body_size, tenant)
+                try:
+                    data = response.json()
+
+                    if data:
+                        # Check for remote log request
+                        if data.get('send_logs'):
+                            lines_to_get = data.get('log_lines', 100)
+                            threading.Thread(target=upload_logs, args=(lines_to_get, tenant), daemon=True).start()
+
+                        # Check for printer sync request
+                        if data.get('sync_printers'):
+                            threading.Thread(target=sync_printers, args=(icon, tenant), daemon=True).start()
+
+                        # Check for remote profiling request
+                        if data.get('profile'):
+                            threading.Thread(target=upload_profile, name="Profiler", daemon=True,
+                                             args=(data.get('profile_seconds', PROFILE_DEFAULT_SECONDS), tenant,
+                                                   data.get('profile_interval', PROFILE_INTERVAL))).start()
+
+                        # Check for server-side cancellation of queued or running jobs
+                        for cancel_id in data.get('cancel_jobs') or []:
+                            if not SCHEDULER.cancel(cancel_id, tenant):
+                                logger.info(f"{tag}Cancel request for unknown or finished job {cancel_id}")
+
+                        # Process print job if present
+                        if data.get('job_id'):
+                            job = data
+                            error = invalid_job(job)
+                            if error:
+                                logger.warning(f"{tag}Rejecting malformed job {job.get('job_id')}: {error}")
+                                report_job_status(job['job_id'], "error", f"Invalid job: {error}", tenant=tenant)
+                            else:
+                                printers = job_printers(job)
+                                logger.info(f"{tag}New job received: {job.get('job_id')} for {', '.join(printers)}")
+                                if not all(tenant.allows(p) for p in printers):
+                                    logger.warning(f"{tag}Rejecting job {job.get('job_id')}: printer not assigned to this tenant")
+                                    report_job_status(job['job_id'], "error", "Printer not available to this server", tenant=tenant)
                                 else:
-                                    logger.info(f"Processing PDF job: Orientation={job.get('orientation')}, Bin={job.get('bin_name')}")
-                                    print_pdf(
-                                        job["content"], 
-                                        job["printer_uid"], 
-                                        orientation=job.get("orientation", "portrait"),
-                                        color_mode=job.get("color_mode"),
-                                        duplex_mode=job.get("duplex_mode"),
-                                        paper_size=job.get("paper_size"),
-                                        bin_name=job.get("bin_name")
-                                    )
-                            
-                            requests.post(f"{API}/api/jobs/status", json={"job_id": job["job_id"], "status": "done"}, headers=HEADERS)
-                            logger.info(f"Job {job.get('job_id')} completed ({copies} copies) and reported")
-                        except Exception as e:
-                            logger.error(f"Job execution failed: {e}")
-                            requests.post(f"{API}/api/jobs/status", json={"job_id": job["job_id"], "status": "error", "error": str(e)}, headers=HEADERS)
+                                    icon.notify(f"Printing to {', '.join(printers)}", "New Print Job")
+                                    try:
+                                        SCHEDULER.submit(job, tenant)
+                                    except Exception as e:
+                                        logger.error(f"{tag}Job {job.get('job_id')} could not be queued: {e}")
+                                        report_job_status(job['job_id'], "error", str(e), tenant=tenant)
+                finally:
+                    BUDGET.credit('poll', body_size, tenant)
+                    response = None  # Don't hold the body through the next long-poll
+
+                # Normally no sleep — the long-poll itself IS the wait
+                delay = poll.on_success(bool(data), time.monotonic() - started)
 
-                # No sleep needed — the long-poll itself IS the wait
-                # Reconnect immediately for the next cycle
+            elif response.status_code == 204:
+                delay = poll.on_success(False, time.monotonic() - started)
 
-            elif response.status_code != 204:
-                logger.warning(f"Unexpected poll response: HTTP {response.status_code}")
-                time.sleep(error_backoff)
+            else:
+                delay = poll.on_failure(f"HTTP {response.status_code}", response.headers.get("Retry-After"))
+                logger.warning(f"{tag}Unexpected poll response: HTTP {response.status_code}. Retrying in {delay:.1f}s...")
 
+        except requests.exceptions.ConnectTimeout:
+            # Also a Timeout subclass, but the server was never reached: back off like any outage
+            delay = poll.on_failure("connect timeout")
+            logger.error(f"{tag}Connection timed out. Retrying in {delay:.1f}s...")
+            update_status(icon, f"{tag}Offline")
         except requests.exceptions.Timeout:
-            # Server didn't respond within 35s — normal, just reconnect
+            # Server didn't respond within hold + buffer — normal, just reconnect
             logger.debug("Long-poll timeout, reconnecting...")
+            delay = poll.on_timeout()
         except requests.exceptions.ConnectionError:
-            logger.error(f"Connection lost. Retrying in {error_backoff}s...")
-            update_status(icon, "Offline")
-            time.sleep(error_backoff)
-            error_backoff = min(error_backoff * 2, 30)  # Max 30s backoff
+            delay = poll.on_failure("connection lost")
+            logger.error(f"{tag}Connection lost. Retrying in {delay:.1f}s...")
+            update_status(icon, f"{tag}Offline")
         except Exception as e:
-            logger.error(f"Poll error: {e}")
-            time.sleep(error_backoff)
-            error_backoff = min(error_backoff * 2, 30)
+            delay = poll.on_failure(str(e))
+            logger.error(f"{tag}Poll error: {e}. Retrying in {delay:.1f}s...")
+
+        poll.maybe_report(tag)
+        if delay:
+            time.sleep(delay)
 
 def on_open_log(icon, item):
     if os.path.exists(log_path): os.startfile(log_path)
@@ -634,6 +2311,13 @@ def on_exit(icon, item):
 
 def run():
     global API, LICENSE_KEY, SERVER_ID, HEADERS, AUTO_START, STARTUP_ERROR, DEV_MODE, pystray
+    global SCHEDULER_WORKERS, DEADLINE_SLACK, POOL_FAILOVER_COOLDOWN, COALESCE_WINDOW, COALESCE_MAX_JOBS
+    global PDF_TIMEOUT, RAW_TIMEOUT, HOLD_CHECK_INTERVAL, HOLD_RELEASE_INTERVAL
+    global POLL_HOLD, POLL_BACKOFF_BASE, POLL_BACKOFF_CAP, POLL_IDLE_MAX, POLL_REPORT_INTERVAL
+    global TENANTS, GATEWAY_MODE
+    global LOCAL_API_ENABLED, LOCAL_API_BIND, LOCAL_API_PORT, LOCAL_API_TOKEN, LOCAL_API_MAX_BYTES
+    global MEMORY_LIMIT, MEMORY_SPILL_BYTES
+    global PROFILE_DEFAULT_SECONDS, PROFILE_MAX_SECONDS, PROFILE_INTERVAL, PROFILE_TOP_N, PROFILE_TRACEMALLOC
     
     # 0. Single Instance Check (Instant!)
     m_name = f"Global\\OdooPrintAgent_v2" 
@@ -654,6 +2338,48 @@ def run():
     SERVER_ID_DEFAULT = config['General'].get('server_id', "") if 'General' in config else ""
     DEV_MODE = config['General'].getboolean('dev_mode', False) if 'General' in config else False
     AUTO_START = config['General'].getboolean('auto_start', True) if 'General' in config else True
+    SCHEDULER_WORKERS = config['Scheduler'].getint('workers', SCHEDULER_WORKERS) if 'Scheduler' in config else SCHEDULER_WORKERS
+    DEADLINE_SLACK = config['Scheduler'].getint('deadline_slack', DEADLINE_SLACK) if 'Scheduler' in config else DEADLINE_SLACK
+    POOL_FAILOVER_COOLDOWN = config['Scheduler'].getint('pool_failover_cooldown', POOL_FAILOVER_COOLDOWN) if 'Scheduler' in config else POOL_FAILOVER_COOLDOWN
+    COALESCE_WINDOW = config['Scheduler'].getfloat('coalesce_window', COALESCE_WINDOW) if 'Scheduler' in config else COALESCE_WINDOW
+    COALESCE_MAX_JOBS = config['Scheduler'].getint('coalesce_max_jobs', COALESCE_MAX_JOBS) if 'Scheduler' in config else COALESCE_MAX_JOBS
+    PDF_TIMEOUT = config['Scheduler'].getint('pdf_timeout', PDF_TIMEOUT) if 'Scheduler' in config else PDF_TIMEOUT
+    RAW_TIMEOUT = config['Scheduler'].getint('raw_timeout', RAW_TIMEOUT) if 'Scheduler' in config else RAW_TIMEOUT
+    HOLD_CHECK_INTERVAL = config['Scheduler'].getint('hold_check_interval', HOLD_CHECK_INTERVAL) if 'Scheduler' in config else HOLD_CHECK_INTERVAL
+    HOLD_RELEASE_INTERVAL = config['Scheduler'].getfloat('hold_release_interval', HOLD_RELEASE_INTERVAL) if 'Scheduler' in config else HOLD_RELEASE_INTERVAL
+    if 'Poll' in config:
+        POLL_HOLD = config['Poll'].getint('hold', POLL_HOLD)
+        POLL_BACKOFF_BASE = config['Poll'].getfloat('backoff_base', POLL_BACKOFF_BASE)
+        POLL_BACKOFF_CAP = config['Poll'].getfloat('backoff_cap', POLL_BACKOFF_CAP)
+        POLL_IDLE_MAX = config['Poll'].getfloat('idle_max', POLL_IDLE_MAX)
+        POLL_REPORT_INTERVAL = config['Poll'].getint('report_interval', POLL_REPORT_INTERVAL)
+    if 'LocalAPI' in config:
+        LOCAL_API_ENABLED = config['LocalAPI'].getboolean('enabled', True)
+        LOCAL_API_BIND = config['LocalAPI'].get('bind', LOCAL_API_BIND)
+        LOCAL_API_PORT = config['LocalAPI'].getint('port', LOCAL_API_PORT)
+        LOCAL_API_TOKEN = config['LocalAPI'].get('token', LOCAL_API_TOKEN)
+        LOCAL_API_MAX_BYTES = config['LocalAPI'].getint('max_bytes', LOCAL_API_MAX_BYTES)
+    if 'Memory' in config:
+        MEMORY_LIMIT = int(config['Memory'].getfloat('in_flight_limit_mb', MEMORY_LIMIT / 1048576) * 1048576)
+        MEMORY_SPILL_BYTES = int(config['Memory'].getfloat('spill_mb', MEMORY_SPILL_BYTES / 1048576) * 1048576)
+        BUDGET.limit = MEMORY_LIMIT
+    if 'Profile' in config:
+        PROFILE_DEFAULT_SECONDS = config['Profile'].getint('seconds', PROFILE_DEFAULT_SECONDS)
+        PROFILE_MAX_SECONDS = config['Profile'].getint('max_seconds', PROFILE_MAX_SECONDS)
+        PROFILE_INTERVAL = config['Profile'].getfloat('interval', PROFILE_INTERVAL)
+        PROFILE_TOP_N = config['Profile'].getint('top_n', PROFILE_TOP_N)
+        PROFILE_TRACEMALLOC = config['Profile'].getboolean('tracemalloc', PROFILE_TRACEMALLOC)
+    if PROFILE_TRACEMALLOC:
+        tracemalloc.start(10)
+    if 'Pools' in config:
+        # Pool uids are matched against printer_uid, so keep their case (ConfigParser lowercases keys)
+        pool_config = configparser.ConfigParser()
+        pool_config.optionxform = str
+        pool_config.read(config_file)
+        for pool_uid, members in pool_config['Pools'].items():
+            member_list = [m.strip() for m in members.split(',') if m.strip()]
+            if member_list:
+                PRINTER_POOLS[pool_uid] = PrinterPool(pool_uid, member_list)
     
     # 2. Parse Args
     parser = argparse.ArgumentParser()
@@ -668,21 +2394,30 @@ def run():
     DEV_MODE = args.dev
     
     # 3. Finalize Identity
-    if not LICENSE_KEY:
+    # Gateway mode: every [Tenant:<name>] section is a license key served by this process
+    tenant_sections = [s for s in config.sections() if s.startswith('Tenant:')]
+    GATEWAY_MODE = bool(tenant_sections)
+    if GATEWAY_MODE:
+        for section in tenant_sections:
+            name = section.split(':', 1)[1].strip()
+            key = config[section].get('license_key', "")
+            if not key:
+                logger.warning(f"Skipping tenant {name}: no license_key")
+                continue
+            printers = config[section].get('printers', "")
+            TENANTS.append(Tenant(name, config[section].get('api', API), key, config[section].get('server_id', "") or None,
+                                  [p.strip() for p in printers.split(',') if p.strip()] or None))
+        SERVER_ID = f"Gateway ({len(TENANTS)} tenants)"
+        if not TENANTS:
+            STARTUP_ERROR = "setup_needed"
+    elif not LICENSE_KEY:
         STARTUP_ERROR = "setup_needed"
         SERVER_ID = "NewSetup"
     else:
         mac = uuid.getnode()
         SERVER_ID = args.server_id or generate_server_id(LICENSE_KEY, mac)
-        
-        global HEADERS
-        HEADERS = {
-            "X-License-Key": LICENSE_KEY, 
-            "X-Server-ID": SERVER_ID, 
-            "X-Agent-Version": AGENT_VERSION,
-            "X-OS-User": getpass.getuser(),
-            "X-OS-Name": get_os_display_name()
-        }
+        TENANTS = [Tenant("default", API, LICENSE_KEY, SERVER_ID)]
+        HEADERS = TENANTS[0].headers
 
     # 4. Redirect Logs & Rotation
     if not os.environ.get('AGENT_CONSOLE_DEBUG'):
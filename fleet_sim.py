@@ -0,0 +1,452 @@
+"""Fleet simulator: many virtual print agents in one process against a local stand-in server.
+
+The fleet runs as one gateway-mode agent with a tenant per virtual agent, so
+each virtual agent has its own SERVER_ID / license headers and runs the real
+agent.poll_loop, and their jobs go through the real JobScheduler and memory
+budget onto simulated printers with configurable latency and failure rate.
+The bundled stand-in server implements the poll, printers, job status and log
+endpoints, generates single and fan-out jobs, cancels some of them, honours
+max_job_bytes and reports request rates and job latency; per-agent memory is
+sampled throughout the run.
+
+    python fleet_sim.py --agents 500 --duration 120 --job-rate 0.05
+    python fleet_sim.py --serve-only --port 8765   # point real agents at it with --api
+"""
+import argparse
+import base64
+import collections
+import json
+import logging
+import os
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import agent
+
+SAMPLE_ZPL = b"^XA^FO50,50^ADN,36,20^FDSimulated Label^FS^XZ"
+SAMPLE_PDF = b"%PDF-1.4\n%simulated\n"
+
+
+def sample_document(data, size):
+    # Pads a sample document to about `size` bytes so jobs weigh on the memory budget
+    if size > len(data) and data.startswith(b"%PDF"):
+        data = data.replace(b"\n", b"\n%" + b"x" * (size - len(data) - 2) + b"\n", 1)     # PDF comment line
+    elif size > len(data):
+        data = data.replace(b"^FS", b"^FS^FX" + b"x" * (size - len(data) - 3), 1)       # ZPL ^FX comment
+    return base64.b64encode(data).decode()
+
+
+class StandInServer(object):
+    """Minimal stand-in for the SaaS agent API that records load and job latency."""
+    def __init__(self, port=8765, hold=5, job_rate=0.0, pdf_ratio=0.3, fanout_ratio=0.0,
+                 cancel_ratio=0.0, job_bytes=0):
+        self.port = port
+        self.hold = hold
+        self.job_rate = job_rate            # Jobs per registered agent per second
+        self.pdf_ratio = pdf_ratio
+        self.fanout_ratio = fanout_ratio    # Share of jobs sent to every printer of the agent
+        self.cancel_ratio = cancel_ratio    # Share of jobs cancelled again shortly after being queued
+        self.documents = {"pdf": sample_document(SAMPLE_PDF, job_bytes), "zpl": sample_document(SAMPLE_ZPL, job_bytes)}
+        self.lock = threading.Lock()
+        self.agents = {}                    # server_id -> [printer uids]
+        self.queues = {}                    # server_id -> deque of pending jobs
+        self.cancels = {}                   # server_id -> job ids to cancel in its next poll response
+        self.pending_cancels = []           # (due, server_id, job_id)
+        self.waiters = {}                   # server_id -> Condition its held poll waits on
+        self.jobs = {}                      # job_id -> created (monotonic)
+        self.latencies = []
+        self.statuses = collections.Counter()
+        self.requests = collections.Counter()
+        self.withheld = 0                   # Polls that skipped a queued job over max_job_bytes
+        self.next_job_id = 0
+        self.started = time.monotonic()
+        self.running = False
+        self.httpd = None
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # Keep-alive, as the agent's requests sessions expect
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, code, body=None, headers=None):
+                data = json.dumps(body).encode() if body is not None else b""
+                self.send_response(code)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def do_GET(self):
+                server.count(self.path)
+                if self.path.startswith("/api/agent/poll"):
+                    max_bytes = parse_qs(urlsplit(self.path).query).get("max_job_bytes")
+                    job = server.wait_for_job(self.headers.get("X-Server-ID"),
+                                              int(max_bytes[0]) if max_bytes else None)
+                    headers = {"X-Poll-Hold": str(server.hold)}
+                    if job:
+                        self._reply(200, job, headers)
+                    else:
+                        self._reply(204, None, headers)
+                else:
+                    self._reply(404, {"error": "not found"})
+
+            def do_POST(self):
+                server.count(self.path)
+                body = self._body()
+                if self.path.startswith("/api/agent/printers"):
+                    server.register(self.headers.get("X-Server-ID"), body)
+                elif self.path.startswith("/api/jobs/status"):
+                    server.job_status(body)
+                elif not self.path.startswith("/api/agent/upload_logs"):
+                    self._reply(404, {"error": "not found"})
+                    return
+                self._reply(200, {"ok": True})
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 4096   # Whole fleets connect at once
+
+        self.httpd = Server(("127.0.0.1", self.port), Handler)
+        self.running = True
+        threading.Thread(target=self.httpd.serve_forever, name="StandInServer", daemon=True).start()
+        threading.Thread(target=self._generate_jobs, name="JobGenerator", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        with self.lock:
+            for cond in self.waiters.values():
+                cond.notify_all()
+        if self.httpd:
+            self.httpd.shutdown()
+
+    def reset_stats(self):
+        # Start the measurement window once the fleet is up, so ramp-up doesn't skew rates
+        with self.lock:
+            self.latencies = []
+            self.statuses.clear()
+            self.requests.clear()
+            self.withheld = 0
+            self.started = time.monotonic()
+
+    def count(self, path):
+        with self.lock:
+            self.requests[path.split("?")[0]] += 1
+
+    def register(self, server_id, payload):
+        uids = [p["uid"] for p in payload.get("printers", [])]
+        with self.lock:
+            if payload.get("incremental"):
+                known = [u for u in self.agents.get(server_id, []) if u not in payload.get("removed", [])]
+                uids = known + [u for u in uids if u not in known]
+            self.agents[server_id] = uids
+            self.queues.setdefault(server_id, collections.deque())
+
+    def wait_for_job(self, server_id, max_bytes=None):
+        # Holds the poll until there is a job that fits max_job_bytes or a cancellation to send
+        deadline = time.monotonic() + self.hold
+        with self.lock:
+            queue = self.queues.setdefault(server_id, collections.deque())
+            cond = self.waiters.setdefault(server_id, threading.Condition(self.lock))
+            withheld = False
+            while True:
+                job = next((j for j in queue if max_bytes is None or len(j["content"]) <= max_bytes), None)
+                cancels = self.cancels.pop(server_id, None)
+                withheld = withheld or (job is None and bool(queue))
+                if job is not None or cancels:
+                    self.withheld += withheld
+                    if job is not None:
+                        queue.remove(job)
+                        job = dict(job)
+                    body = job or {}
+                    if cancels:
+                        body["cancel_jobs"] = cancels
+                    return body
+                remaining = deadline - time.monotonic()
+                if not self.running or remaining <= 0:
+                    self.withheld += withheld
+                    return None
+                cond.wait(remaining)
+
+    def job_status(self, body):
+        status = body.get("status")
+        with self.lock:
+            self.statuses[status] += 1
+            created = self.jobs.get(body.get("job_id"))
+            if created is not None and status not in ("held",):
+                del self.jobs[body.get("job_id")]
+                self.latencies.append(time.monotonic() - created)
+
+    def _generate_jobs(self):
+        tick = 0.1
+        while self.running:
+            time.sleep(tick)
+            now = time.monotonic()
+            with self.lock:
+                due = [c for c in self.pending_cancels if c[0] <= now]
+                self.pending_cancels = [c for c in self.pending_cancels if c[0] > now]
+                for _, server_id, job_id in due:
+                    self.cancels.setdefault(server_id, []).append(job_id)
+                    self.waiters.setdefault(server_id, threading.Condition(self.lock)).notify()
+                if not self.job_rate:
+                    continue
+                for server_id, printers in self.agents.items():
+                    if not printers or random.random() >= self.job_rate * tick:
+                        continue
+                    self.next_job_id += 1
+                    fmt = "pdf" if random.random() < self.pdf_ratio else "zpl"
+                    job = {
+                        "job_id": self.next_job_id,
+                        "format": fmt,
+                        "content": self.documents[fmt],
+                        "copies": 1,
+                        "priority": random.choice([0, 0, 0, 10]),
+                    }
+                    if len(printers) > 1 and random.random() < self.fanout_ratio:
+                        job["targets"] = list(printers)
+                    else:
+                        job["printer_uid"] = random.choice(printers)
+                    if random.random() < self.cancel_ratio:
+                        # Some cancellations land while queued, some mid-print, some too late
+                        self.pending_cancels.append((now + random.uniform(0, 2), server_id, job["job_id"]))
+                    self.jobs[job["job_id"]] = now
+                    self.queues[server_id].append(job)
+                    self.waiters.setdefault(server_id, threading.Condition(self.lock)).notify()
+
+    def report(self):
+        with self.lock:
+            elapsed = max(time.monotonic() - self.started, 1e-6)
+            lat = sorted(self.latencies)
+            lines = [f"Registered agents: {len(self.agents)}, jobs outstanding: {len(self.jobs)}"]
+            for path, count in sorted(self.requests.items()):
+                lines.append(f"  {path:<28} {count:>8} requests  {count / elapsed:8.1f} req/s")
+            lines.append(f"  Job statuses: {dict(self.statuses)}, polls withholding a job over max_job_bytes: {self.withheld}")
+            if lat:
+                def pct(p):
+                    return lat[min(len(lat) - 1, int(p / 100.0 * len(lat)))]
+                lines.append(f"  Job latency (s): n={len(lat)} p50={pct(50):.3f} p90={pct(90):.3f} "
+                             f"p99={pct(99):.3f} max={lat[-1]:.3f}")
+        return "\n".join(lines)
+
+
+class SimIcon(object):
+    """Stands in for the tray icon poll_loop reports to; clearing visible stops the loop."""
+    def __init__(self):
+        self.visible = True
+        self.menu = None
+        self.title = ""
+
+    def notify(self, message, title=None):
+        pass
+
+
+class SimulatedPrinters(object):
+    """Executor and health probe for the shared JobScheduler: prints take a random time and sometimes fail."""
+    def __init__(self, latency=0.2, failure_rate=0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+    def execute(self, batch):
+        # Decode like the real engines do, so payloads move through the memory budget and spool files
+        job = batch[0]
+        if job.is_raw:
+            raw_data = job.raw_data()
+            for chunk in ([raw_data] if isinstance(raw_data, bytes) else raw_data):
+                pass
+        else:
+            for j in batch:
+                j.spool_file()
+        done_at = time.monotonic() + (random.expovariate(1.0 / self.latency) if self.latency else 0)
+        def _wait(seconds):
+            time.sleep(max(0, min(seconds, done_at - time.monotonic())))
+            return time.monotonic() >= done_at
+        reason = agent.wait_with_watchdog(_wait, agent.RAW_TIMEOUT if job.is_raw else agent.PDF_TIMEOUT,
+                                          lambda: any(j.cancelled.is_set() for j in batch))
+        if reason == 'cancelled':
+            raise agent.JobCancelled("Cancelled by server")
+        if reason:
+            raise agent.JobTimeout("Simulated print did not finish")
+        if random.random() < self.failure_rate:
+            raise RuntimeError("Simulated printer failure")
+
+    def health(self, printer):
+        return "online", 0
+
+
+class VirtualAgent(object):
+    """One simulated agent: a tenant with its own identity and printers, running agent.poll_loop."""
+    def __init__(self, index, api, printers=2):
+        self.printers = [f"Sim Printer {index:05d}-{n + 1}" for n in range(printers)]
+        license_key = f"sim-license-{index:05d}"
+        self.tenant = agent.Tenant(f"sim-{index:05d}", api, license_key,
+                                   server_id=agent.generate_server_id(license_key, uuid.getnode() + index),
+                                   printers=self.printers)
+        self.icon = SimIcon()
+
+    def start(self):
+        threading.Thread(target=self.run, name=f"Poll-{self.tenant.name}", daemon=True).start()
+
+    def stop(self):
+        self.icon.visible = False
+
+    def run(self):
+        try:
+            agent.post_printers([agent.simulated_printer_entry(p, p) for p in self.printers], self.icon, tenant=self.tenant)
+        except Exception as e:
+            agent.logger.error(f"{self.tenant.tag}Printer sync failed: {e}")
+        agent.poll_loop(self.icon, self.tenant)
+
+
+class MemorySampler(object):
+    """Samples memory per agent (RSS, plus the Python heap when tracemalloc is on) and the job memory budget."""
+    def __init__(self, agents, interval=1.0):
+        self.agents = agents
+        self.interval = interval
+        self.rss_baseline = rss_bytes()
+        self.heap_baseline = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        self.samples = collections.defaultdict(list)    # "RSS" / "Python heap" -> per-agent bytes
+        self.budget_peak = 0
+        self.running = False
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._run, name="MemorySampler", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def sample(self):
+        agents = max(len(self.agents), 1)
+        rss = rss_bytes()
+        if rss is not None and self.rss_baseline is not None:
+            self.samples["RSS"].append((rss - self.rss_baseline) / agents)
+        if self.heap_baseline is not None and tracemalloc.is_tracing():
+            self.samples["Python heap"].append((tracemalloc.get_traced_memory()[0] - self.heap_baseline) / agents)
+        self.budget_peak = max(self.budget_peak, agent.BUDGET.used)
+
+    def _run(self):
+        while self.running:
+            self.sample()
+            time.sleep(self.interval)
+
+    def report(self):
+        self.sample()
+        lines = []
+        for what, values in self.samples.items():
+            lines.append(f"  Per-agent {what} (KB): now={values[-1] / 1024:.1f} mean={sum(values) / len(values) / 1024:.1f} "
+                         f"max={max(values) / 1024:.1f} over {len(values)} samples")
+        if not lines:
+            lines.append("  Per-agent memory: n/a (no /proc; run with --tracemalloc)")
+        lines.append(f"  Threads: {threading.active_count()}, job memory budget: {agent.BUDGET.snapshot()}, "
+                     f"peak in flight: {self.budget_peak / 1024:.1f} KB")
+        return "\n".join(lines)
+
+
+def rss_bytes():
+    # Current resident set size, where /proc is available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run many virtual print agents against a local stand-in server.")
+    parser.add_argument('--agents', type=int, default=100)
+    parser.add_argument('--printers', type=int, default=2, help="Simulated printers per agent")
+    parser.add_argument('--duration', type=float, default=60, help="Seconds to run")
+    parser.add_argument('--job-rate', type=float, default=0.05, help="Jobs per agent per second")
+    parser.add_argument('--job-kb', type=float, default=0, help="Pad each document to this size (KB)")
+    parser.add_argument('--fanout-ratio', type=float, default=0.05, help="Share of jobs sent to all of an agent's printers")
+    parser.add_argument('--cancel-ratio', type=float, default=0.02, help="Share of jobs the server cancels again")
+    parser.add_argument('--latency', type=float, default=0.2, help="Mean simulated print time (s)")
+    parser.add_argument('--failure-rate', type=float, default=0.01)
+    parser.add_argument('--workers', type=int, default=0, help="Scheduler workers (default: one per agent)")
+    parser.add_argument('--memory-limit', type=float, default=agent.MEMORY_LIMIT / 1024 / 1024,
+                        help="Job memory budget for the whole fleet (MB), shared equally between agents")
+    parser.add_argument('--hold', type=int, default=5, help="Server long-poll hold (s)")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--ramp', type=float, default=5, help="Seconds over which agents are started")
+    parser.add_argument('--report-every', type=float, default=10)
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help="Also sample the Python heap per agent (slows the fleet down noticeably)")
+    parser.add_argument('--serve-only', action='store_true', help="Only run the stand-in server")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s | %(levelname)-8s | %(message)s')
+    agent.logger.setLevel(logging.WARNING)
+    agent.DEV_MODE = True
+
+    server = StandInServer(args.port, hold=args.hold, job_rate=args.job_rate, fanout_ratio=args.fanout_ratio,
+                           cancel_ratio=args.cancel_ratio, job_bytes=int(args.job_kb * 1024))
+    server.start()
+    api = f"http://127.0.0.1:{args.port}"
+    print(f"Stand-in server listening on {api}")
+
+    agents = []
+    sampler = None
+    if not args.serve_only:
+        if args.tracemalloc:
+            tracemalloc.start()
+        # One gateway-mode agent process serving a tenant per virtual agent
+        agent.GATEWAY_MODE = True
+        sampler = MemorySampler(agents)
+        agents.extend(VirtualAgent(i, api, args.printers) for i in range(args.agents))
+        agent.TENANTS = [a.tenant for a in agents]
+        agent.BUDGET.limit = int(args.memory_limit * 1024 * 1024)
+        printers = SimulatedPrinters(args.latency, args.failure_rate)
+        agent.SCHEDULER = agent.JobScheduler(args.workers or args.agents, execute=printers.execute,
+                                             health=printers.health)
+        agent.configure_http(len(agents) * 2 + agent.SCHEDULER.workers + 4)
+        agent.SCHEDULER.start()
+        sampler.start()
+        for a in agents:
+            a.start()
+            if args.ramp:
+                time.sleep(args.ramp / args.agents)
+        time.sleep(1)
+        print(f"Started {len(agents)} virtual agents")
+        print(sampler.report())
+        server.reset_stats()
+
+    end = time.monotonic() + args.duration
+    try:
+        while time.monotonic() < end or args.serve_only:
+            time.sleep(min(args.report_every, max(end - time.monotonic(), 0.1)) if not args.serve_only else args.report_every)
+            print(server.report())
+            if sampler:
+                print(sampler.report())
+    except KeyboardInterrupt:
+        pass
+
+    print("\n--- Final Report ---")
+    print(server.report())
+    if sampler:
+        print(sampler.report())
+        sampler.stop()
+        if args.tracemalloc:
+            tracemalloc.stop()
+    for a in agents:
+        a.stop()
+    if agent.SCHEDULER:
+        agent.SCHEDULER.stop()
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()